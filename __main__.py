@@ -0,0 +1,5 @@
+import sys
+
+from .remcon_cli import main
+
+sys.exit(main())
@@ -0,0 +1,99 @@
+'''
+kV / WD indexed column alignment table
+
+Collects aligned stig, aperture and gun alignment values seen at many
+(kV, WD, aperture) conditions and interpolates suggested values for any
+other condition. Interpolation is inverse distance weighted over the nearest
+points with the same aperture, distances normalized by kV_scale and
+WD_scale. Rows are appended to a csv file as they are added.
+'''
+import os
+import time
+
+import numpy as np
+
+
+class AlignmentCalibration(object):
+
+    columns = ['kV', 'WD', 'aperture', 'stig_x', 'stig_y',
+               'aperture_x', 'aperture_y', 'gun_x', 'gun_y', 'time']
+    value_columns = columns[3:9]
+
+    def __init__(self, fname=None, kV_scale=1.0, WD_scale=1.0, n_nearest=6, power=2.0):
+        '''
+        kV_scale (kV) and WD_scale (mm) set how far apart conditions count as equally different
+        '''
+        self.fname = fname
+        self.kV_scale = kV_scale
+        self.WD_scale = WD_scale
+        self.n_nearest = n_nearest
+        self.power = power
+        self.data = np.zeros((0, len(self.columns)))
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        data = np.loadtxt(self.fname, delimiter=',', ndmin=2)
+        self.data = data.reshape(-1, len(self.columns))
+
+    def save(self):
+        np.savetxt(self.fname, self.data, delimiter=',', fmt='%.6g',
+                   header=','.join(self.columns))
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, kV, WD, aperture, values, tol=0.01):
+        '''
+        values: dict with value_columns keys
+        replaces any row at the same condition (within tol), otherwise appends
+        '''
+        row = np.array([kV, WD, aperture] + [values[c] for c in self.value_columns]
+                       + [time.time()], dtype=float)
+        same = ((self.data[:, 2] == aperture)
+                & (np.abs(self.data[:, 0] - kV) < tol)
+                & (np.abs(self.data[:, 1] - WD) < tol))
+        if np.any(same):
+            self.data = np.vstack([self.data[~same], row])
+            if self.fname:
+                self.save()
+            return
+        self.data = np.vstack([self.data, row])
+        if not self.fname:
+            return
+        if not os.path.exists(self.fname):
+            self.save()
+            return
+        # incremental, only the new row hits the disk
+        with open(self.fname, 'a') as f:
+            np.savetxt(f, row[None, :], delimiter=',', fmt='%.6g')
+
+    def suggest_many(self, kV, WD, aperture):
+        '''
+        vectorized: kV, WD arrays of M conditions, one aperture
+        returns (M, 6) array of value_columns, NaN rows if no data for this aperture
+        '''
+        kV = np.atleast_1d(np.asarray(kV, dtype=float))
+        WD = np.atleast_1d(np.asarray(WD, dtype=float))
+        rows = self.data[self.data[:, 2] == aperture]
+        out = np.full((len(kV), len(self.value_columns)), np.nan)
+        if len(rows) == 0:
+            return out
+        d = np.hypot((kV[:, None] - rows[None, :, 0]) / self.kV_scale,
+                     (WD[:, None] - rows[None, :, 1]) / self.WD_scale)   # (M, N)
+        k = min(self.n_nearest, len(rows))
+        nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+        dk = np.take_along_axis(d, nearest, axis=1)
+        w = 1.0 / np.maximum(dk, 1e-9)**self.power  # exact hits dominate
+        w /= w.sum(axis=1, keepdims=True)
+        values = rows[:, 3:9][nearest]                                   # (M, k, 6)
+        return np.einsum('mk,mkv->mv', w, values)
+
+    def suggest(self, kV, WD, aperture):
+        'dict of suggested value_columns, None if no data for this aperture'
+        v = self.suggest_many(kV, WD, aperture)[0]
+        if np.isnan(v[0]):
+            return None
+        return dict(zip(self.value_columns, v))
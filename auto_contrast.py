@@ -0,0 +1,137 @@
+'''
+Auto brightness / contrast for both detector channels
+
+Frames come from a user acquire function. Black and white levels are taken
+from a histogram of subsampled pixels (np.bincount), contrast is stepped on
+the log of the black-white span and brightness on the mid level, with step
+gains learned from the previous iteration. Writes below a deadband are
+skipped and all writes for a display zone go out in one zone visit
+(Remcon32.set_chan_levels), with a single switch back to the primary zone at
+the end of each iteration.
+'''
+import time
+
+import numpy as np
+
+
+def histogram_levels(frame, full_scale=(0, 65535), low=0.005, high=0.995,
+                     step=4, n_bins=1024):
+    '''
+    returns black, white levels (fraction of full scale at the low and high
+    quantiles) and the fractions of pixels saturated at either end
+    '''
+    sub = np.asarray(frame)[::step, ::step].ravel()
+    lo, hi = full_scale
+    bins = ((sub.astype(np.float32) - lo) * ((n_bins - 1) / float(hi - lo)))
+    bins = np.clip(bins, 0, n_bins - 1).astype(np.intp)
+    hist = np.bincount(bins, minlength=n_bins)
+    cdf = np.cumsum(hist) / float(len(bins))
+    black = np.searchsorted(cdf, low) / float(n_bins - 1)
+    white = np.searchsorted(cdf, high) / float(n_bins - 1)
+    return black, white, hist[0] / float(len(bins)), hist[-1] / float(len(bins))
+
+
+class AutoContrast(object):
+
+    def __init__(self, remcon, acquire_func, full_scale=(0, 65535),
+                 target_black=0.05, target_white=0.90, tol=0.02, max_iter=8,
+                 subsample=4, deadband=0.2):
+        '''
+        remcon: Remcon32 instance
+        acquire_func(): returns sequence of frames indexed by channel (0 primary, 1 secondary)
+        full_scale: raw data values of 0% and 100% signal
+        target_black, target_white: desired 0.5% / 99.5% quantile levels, fraction of full scale
+        tol: accepted level error, deadband: smallest contrast/brightness write in %
+        '''
+        self.remcon = remcon
+        self.acquire_func = acquire_func
+        self.full_scale = full_scale
+        self.target_black = target_black
+        self.target_white = target_white
+        self.tol = tol
+        self.max_iter = max_iter
+        self.subsample = subsample
+        self.deadband = deadband
+        # initial step gains, refined by secant after each step
+        self.contrast_gain = 10.0 # contrast % per e-fold of black-white span
+        self.bright_gain = 100.0  # brightness % per full scale of mid level
+
+    def levels(self, frame):
+        return histogram_levels(frame, self.full_scale, step=self.subsample)
+
+    def run(self, channels=(0, 1)):
+        R = self.remcon
+        t0 = time.perf_counter()
+        n_writes = 0
+        n_iter = 0
+        target_span = self.target_white - self.target_black
+        target_mid = 0.5*(self.target_white + self.target_black)
+
+        state = dict()
+        for ch in channels:
+            c, b = R.get_chan_levels(primary=(ch == 0))
+            state[ch] = dict(contrast=c, bright=b, converged=False,
+                             c_gain=self.contrast_gain, b_gain=self.bright_gain, last=None)
+
+        for it in range(self.max_iter):
+            n_iter = it + 1
+            frames = self.acquire_func()
+            writes = []
+            for ch in channels:
+                st = state[ch]
+                black, white, sat_lo, sat_hi = self.levels(frames[ch])
+                span = max(white - black, 1e-3)
+                mid = 0.5*(white + black)
+                st.update(black=black, white=white, sat_low=sat_lo, sat_high=sat_hi)
+
+                if st['last'] is not None:
+                    # learn gains from what the previous write actually did
+                    dc, db, old_span, old_mid = st['last']
+                    d_log_span = np.log(span) - np.log(old_span)
+                    if abs(dc) > self.deadband and d_log_span * dc > 0 and abs(d_log_span) > 0.02:
+                        st['c_gain'] = float(np.clip(dc / d_log_span, 1.0, 50.0))
+                    if abs(db) > self.deadband and (mid - old_mid) * db > 0 and abs(mid - old_mid) > 0.005:
+                        st['b_gain'] = float(np.clip(db / (mid - old_mid), 10.0, 500.0))
+
+                if (abs(black - self.target_black) <= self.tol
+                        and abs(white - self.target_white) <= self.tol):
+                    st['converged'] = True
+                    st['last'] = None
+                    continue
+                st['converged'] = False
+                if sat_hi > 0.01 or sat_lo > 0.01:
+                    # clipped, span is underestimated, back off contrast by a fixed step
+                    dc = -0.5*st['c_gain']
+                else:
+                    dc = st['c_gain'] * np.log(target_span / span)
+                db = st['b_gain'] * (target_mid - mid)
+                new_c = float(np.clip(st['contrast'] + dc, 0, 100))
+                new_b = float(np.clip(st['bright'] + db, 0, 100))
+                dc, db = new_c - st['contrast'], new_b - st['bright']
+                st['last'] = (dc, db, span, mid)
+                write_c = new_c if abs(dc) >= self.deadband else None
+                write_b = new_b if abs(db) >= self.deadband else None
+                if write_c is None and write_b is None:
+                    st['converged'] = True # cannot do better than the deadband
+                    continue
+                writes.append((ch, write_c, write_b))
+
+            if not writes:
+                break
+            # primary zone last, so no extra switch back is needed
+            writes.sort(key=lambda w: w[0] == 0)
+            for ch, c, b in writes:
+                R.set_chan_levels(contrast=c, bright=b, primary=(ch == 0), restore_zone=False)
+                n_writes += (c is not None) + (b is not None)
+                if c is not None:
+                    state[ch]['contrast'] = c
+                if b is not None:
+                    state[ch]['bright'] = b
+            if writes[-1][0] != 0:
+                R.display_focus_state(True)
+
+        result = {ch: dict((k, v) for k, v in state[ch].items() if k != 'last') for ch in channels}
+        result['n_writes'] = n_writes
+        result['iterations'] = n_iter
+        result['time'] = time.perf_counter() - t0
+        return result
@@ -0,0 +1,110 @@
+'''
+Beam shift and stage calibration for hybrid fine positioning
+
+Field offsets are in metres in image axes (x along scan lines, y down the
+frame). Two 2x2 matrices are stored:
+    shift_matrix  field offset (m) per beam shift %, at working distance wd_ref
+    stage_matrix  field offset (m) per stage move (mm), x and y axes
+Both are measured by acquiring frames and cross-correlating them, see
+calibrate_shift and calibrate_stage, and saved to a json file.
+'''
+import json
+import os
+import time
+
+import numpy as np
+
+from .image_shift import estimate_shift
+from .remcon_shadow_state import save_json
+
+
+class BeamShiftCalibration(object):
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.shift_matrix = None
+        self.wd_ref = None
+        self.stage_matrix = np.diag([1e-3, 1e-3]) # uncalibrated guess, stage axes == image axes
+        self.time = None
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    @property
+    def calibrated(self):
+        return self.shift_matrix is not None
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with open(self.fname, 'r') as f:
+            d = json.load(f)
+        self.shift_matrix = np.array(d['shift_matrix']) if d.get('shift_matrix') else None
+        self.wd_ref = d.get('wd_ref')
+        self.stage_matrix = np.array(d['stage_matrix'])
+        self.time = d.get('time')
+
+    def save(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        d = dict(shift_matrix=None if self.shift_matrix is None else self.shift_matrix.tolist(),
+                 wd_ref=self.wd_ref,
+                 stage_matrix=self.stage_matrix.tolist(),
+                 time=self.time)
+        save_json(self.fname, d, indent=1)
+
+    def shift_matrix_at(self, wd=None):
+        # beam shift is a deflection, field offset grows with WD
+        if not self.calibrated:
+            raise ValueError("beam shift not calibrated")
+        if wd is None or not self.wd_ref:
+            return self.shift_matrix
+        return self.shift_matrix * (wd / self.wd_ref)
+
+    def shift_to_offset(self, shift_pct, wd=None):
+        return self.shift_matrix_at(wd) @ np.asarray(shift_pct, dtype=float)
+
+    def offset_to_shift(self, offset_m, wd=None):
+        return np.linalg.solve(self.shift_matrix_at(wd), np.asarray(offset_m, dtype=float))
+
+    def offset_to_stage(self, offset_m):
+        'stage move (mm) that produces field offset_m'
+        return np.linalg.solve(self.stage_matrix, np.asarray(offset_m, dtype=float))
+
+    @staticmethod
+    def _measure_columns(apply_func, acquire_func, pixel_size, step):
+        # field offset is opposite to feature motion in the image
+        apply_func(0.0, 0.0)
+        ref = acquire_func()
+        cols = []
+        for dx, dy in [(step, 0.0), (0.0, step)]:
+            apply_func(dx, dy)
+            sx, sy, peak = estimate_shift(ref, acquire_func())
+            if peak < 0.05:
+                print("BeamShiftCalibration: weak correlation peak {:.3f}".format(peak))
+            cols.append([-sx*pixel_size/step, -sy*pixel_size/step])
+        apply_func(0.0, 0.0)
+        return np.array(cols).T
+
+    def calibrate_shift(self, set_shift, acquire_func, pixel_size, wd, step=20.0):
+        '''
+        set_shift(x, y): applies beam shift in %
+        acquire_func(): returns frame, pixel_size (m) its pixel size
+        step: % beam shift used for each axis, must stay well inside the frame
+        '''
+        self.shift_matrix = self._measure_columns(set_shift, acquire_func, pixel_size, step)
+        self.wd_ref = wd
+        self.time = time.time()
+        return self.shift_matrix
+
+    def calibrate_stage(self, move_stage, acquire_func, pixel_size, step=0.005):
+        '''
+        move_stage(dx, dy): relative stage move (mm) that returns once the move is complete
+        step: mm, must stay well inside the frame
+        '''
+        pos = [0.0, 0.0]
+        def move_to(x, y):
+            move_stage(x - pos[0], y - pos[1])
+            pos[0], pos[1] = x, y
+        self.stage_matrix = self._measure_columns(move_to, acquire_func, pixel_size, step)
+        self.time = time.time()
+        return self.stage_matrix
@@ -0,0 +1,182 @@
+'''
+Closed loop drift compensation with beam shift
+
+Reference frames from a user acquire function are cross-correlated with the
+first frame to measure sample drift. A constant velocity Kalman filter
+tracks drift and predicts it between measurements, the prediction is applied
+continuously as beam shift through SEM_Remcon_HW.beamshift_calib. While the
+measured residual stays small the measurement interval is stretched.
+Frames whose correlation peak is below min_peak (beam blanked, field
+changed) are rejected and not fed to the filter.
+'''
+import threading
+import time
+
+import numpy as np
+
+from .image_shift import estimate_shift
+
+
+class DriftKalman(object):
+    '''
+    constant velocity model, x and y independent with the same noise
+    state columns are axes, rows are [position (m), velocity (m/s)]
+    '''
+
+    def __init__(self, accel_noise=1e-21, meas_noise=(2e-9)**2):
+        self.q = accel_noise  # m^2/s^3, white acceleration spectral density
+        self.r = meas_noise   # m^2
+        self.reset()
+
+    def reset(self):
+        self.x = np.zeros((2, 2))
+        self.P = np.diag([1e-14, 1e-18])
+        self.t = None
+
+    def _propagate(self, dt):
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = self.q * np.array([[dt**3/3, dt**2/2], [dt**2/2, dt]])
+        return F @ self.x, F @ self.P @ F.T + Q
+
+    def predict(self, t):
+        'predicted drift (m, [x, y]) at time t'
+        if self.t is None:
+            return self.x[0].copy()
+        x, P = self._propagate(t - self.t)
+        return x[0]
+
+    def update(self, t, z):
+        z = np.asarray(z, dtype=float)
+        if self.t is None:
+            self.x[0] = z
+            self.t = t
+            return self.x[0].copy()
+        x, P = self._propagate(t - self.t)
+        S = P[0, 0] + self.r
+        K = P[:, 0] / S
+        x = x + np.outer(K, z - x[0])
+        P = P - np.outer(K, P[0, :])
+        self.x, self.P, self.t = x, P, t
+        return self.x[0].copy()
+
+    @property
+    def velocity(self):
+        return self.x[1].copy()
+
+
+class DriftCorrector(object):
+
+    log_columns = ['t', 'meas_x', 'meas_y', 'est_x', 'est_y', 'vel_x', 'vel_y',
+                   'shift_x', 'shift_y', 'peak']
+
+    def __init__(self, hw, acquire_func, interval=30.0, max_interval=300.0,
+                 correction_period=1.0, residual_tol=2.0, min_peak=0.05, kalman=None):
+        '''
+        hw: connected SEM_Remcon_HW with calibrated beam shift
+        acquire_func(): returns reference frame, same field each time
+        interval: s between reference frames, stretched up to max_interval
+            while residual drift is below residual_tol pixels
+        correction_period: s between predictive beam shift updates
+        min_peak: lowest normalized correlation peak accepted as a measurement
+        '''
+        self.hw = hw
+        self.acquire_func = acquire_func
+        self.min_interval = interval
+        self.interval = interval
+        self.max_interval = max_interval
+        self.correction_period = correction_period
+        self.residual_tol = residual_tol
+        self.min_peak = min_peak
+        self.n_rejected = 0
+        self.kalman = kalman or DriftKalman()
+
+        self.ref = None
+        self.t0 = None
+        self.base_shift = None
+        self.log = []
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def current_shift(self):
+        return np.asarray(self.hw.settings['beamshift_xy'], dtype=float)
+
+    def measure_once(self):
+        'acquire a frame, update drift estimate, returns measured drift (m) or None if rejected'
+        frame = self.acquire_func()
+        t = time.time()
+        if self.ref is None:
+            self.ref = np.asarray(frame)
+            self.t0 = t
+            self.base_shift = self.current_shift()
+            self.kalman.update(0.0, [0.0, 0.0])
+            return np.zeros(2)
+        pixel_size = self.hw.settings['full_size'] / self.ref.shape[1]
+        dx, dy, peak = estimate_shift(self.ref, frame)
+        if peak < self.min_peak:
+            self.n_rejected += 1
+            self.interval = self.min_interval
+            print("DriftCorrector: correlation peak {:.3f} below {:.3f}, frame rejected".format(
+                peak, self.min_peak))
+            return None
+        residual = np.array([dx, dy]) * pixel_size
+        # features move by drift minus the field offset we already applied
+        shift = self.current_shift()
+        applied = self.hw.beamshift_calib.shift_to_offset(shift - self.base_shift, self.hw.settings['WD'])
+        drift = residual + applied
+        est = self.kalman.update(t - self.t0, drift)
+        vel = self.kalman.velocity
+        self.log.append((t, drift[0], drift[1], est[0], est[1], vel[0], vel[1],
+                         shift[0], shift[1], peak))
+
+        if np.hypot(dx, dy) < self.residual_tol:
+            self.interval = min(self.max_interval, 1.5*self.interval)
+        else:
+            self.interval = self.min_interval
+        return drift
+
+    def apply_prediction(self, t=None):
+        'set beam shift to cancel predicted drift at time t (default now)'
+        if self.ref is None:
+            return
+        if t is None:
+            t = time.time()
+        d = self.kalman.predict(t - self.t0)
+        target = self.base_shift + self.hw.beamshift_calib.offset_to_shift(d, self.hw.settings['WD'])
+        limit = self.hw.settings['beamshift_limit']
+        if np.any(np.abs(target) > limit):
+            print("DriftCorrector: beam shift limit reached, drift {} m".format(d))
+            target = np.clip(target, -limit, limit)
+        self.hw.settings['beamshift_xy'] = target
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True, name='drift_correction')
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        t_next_measure = time.time()
+        while not self.stop_event.is_set():
+            if time.time() >= t_next_measure:
+                try:
+                    self.measure_once()
+                except Exception as err:
+                    print("DriftCorrector: measurement failed", err)
+                t_next_measure = time.time() + self.interval
+            try:
+                self.apply_prediction()
+            except (IOError, ValueError) as err:
+                print("DriftCorrector: beam shift write failed", err)
+            self.stop_event.wait(self.correction_period)
+
+    def trajectory(self):
+        'drift log as (N, len(log_columns)) array'
+        return np.array(self.log, dtype=float).reshape(-1, len(self.log_columns))
+
+    def save_log(self, fname):
+        np.savetxt(fname, self.trajectory(), delimiter=',', fmt='%.9g',
+                   header=','.join(self.log_columns))
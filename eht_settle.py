@@ -0,0 +1,126 @@
+'''
+EHT settle tracking for Remcon32
+
+set_kV returns immediately while EHT ramps for seconds. EHTSettleTracker
+predicts ramp time from history, fitted as delay + |delta kV| / rate, sleeps
+most of the predicted time and polls EHT? with a backoff only near the end.
+Each completed ramp is added back into the history.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from .remcon_shadow_state import save_json
+from .remcon_trace import tracer
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='eht_settle')
+    return _executor
+
+
+class EHTSettleTracker(object):
+
+    def __init__(self, fname=None, default_rate=2.0, default_delay=0.5, history_len=100):
+        '''
+        default_rate: kV/s and default_delay: s, used until enough history is collected
+        fname: optional json file the history is kept in
+        '''
+        self.fname = fname
+        self.default_rate = default_rate
+        self.default_delay = default_delay
+        self.history_len = history_len
+        self.history = [] # (from_kV, to_kV, duration)
+        self.lock = threading.Lock()
+        self.delay, self.rate = default_delay, default_rate
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with open(self.fname, 'r') as f:
+            self.history = [tuple(h) for h in json.load(f)][-self.history_len:]
+        self.fit()
+
+    def save(self):
+        if not self.fname:
+            return
+        save_json(self.fname, self.history)
+
+    def fit(self):
+        'least squares fit of duration = delay + |dkV| / rate over history'
+        with self.lock:
+            h = np.array(self.history, dtype=float).reshape(-1, 3)
+        if len(h) < 3:
+            return self.delay, self.rate
+        dkV = np.abs(h[:, 1] - h[:, 0])
+        if np.ptp(dkV) < 0.1:
+            return self.delay, self.rate
+        slope, delay = np.polyfit(dkV, h[:, 2], 1)
+        if slope > 0:
+            self.rate = 1.0 / slope
+            self.delay = max(0.0, delay)
+        return self.delay, self.rate
+
+    def predict(self, from_kV, to_kV):
+        'predicted ramp time, s'
+        return self.delay + abs(to_kV - from_kV) / self.rate
+
+    def record(self, from_kV, to_kV, duration):
+        with self.lock:
+            self.history.append((float(from_kV), float(to_kV), float(duration)))
+            del self.history[:-self.history_len]
+        self.fit()
+        self.save()
+
+    def wait_for_kV(self, remcon, target, from_kV, t_start=None, tol=0.05,
+                    timeout=60.0, min_poll=0.05, max_poll=1.0, record_factor=2.0):
+        '''
+        block until remcon EHT? is within tol kV of target
+        t_start: time.time() when set_kV was sent, default now
+        returns time from t_start to settled, raises IOError on timeout
+        the duration is added to the history only if the ramp was still running
+        at the first poll or settled within record_factor * predicted time,
+        a wait long after the ramp ended would record how late it started
+        '''
+        if t_start is None:
+            t_start = time.time()
+        t_ramp = self.predict(from_kV, target)
+        t_pred = t_start + t_ramp
+        # most of the ramp without traffic on the link
+        sleep = t_start + 0.8*(t_pred - t_start) - time.time()
+        if sleep > 0:
+            time.sleep(sleep)
+        poll = min_poll
+        ramping_seen = False
+        while True:
+            now = time.time()
+            if abs(remcon.get_kV() - target) <= tol:
+                duration = now - t_start
+                tracer.instant('eht_settled', 'eht', from_kV=from_kV, to_kV=target, duration=duration)
+                if ramping_seen or duration <= record_factor*t_ramp:
+                    self.record(from_kV, target, duration)
+                return duration
+            ramping_seen = True
+            if now - t_start > timeout:
+                raise IOError("EHT did not reach {} kV within {} s".format(target, timeout))
+            if now < t_pred:
+                # before predicted end, poll at half the remaining time
+                poll = min(max_poll, max(min_poll, 0.5*(t_pred - now)))
+            else:
+                poll = min(max_poll, 1.5*poll)
+            time.sleep(poll)
+
+    def kV_future(self, remcon, target, from_kV, **kwargs):
+        'wait_for_kV in a worker thread, returns concurrent.futures.Future'
+        return _get_executor().submit(self.wait_for_kV, remcon, target, from_kV, **kwargs)
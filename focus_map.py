@@ -0,0 +1,144 @@
+'''
+Stage XY focus map
+
+Records (stage x, y) -> WD points where focus was found and fits a surface
+through them, so WD can be set from the map at any stage position. Models:
+plane, quadratic, or a thin plate spline ('tps'). Outliers are rejected
+iteratively on the residual of a plane (or, with 8+ points, quadratic) fit,
+threshold outlier_sigma robust standard deviations (MAD).
+'''
+import json
+import os
+import time
+
+import numpy as np
+
+from .remcon_shadow_state import save_json
+
+
+def _design(x, y, order):
+    cols = [np.ones_like(x), x, y]
+    if order == 2:
+        cols += [x*x, x*y, y*y]
+    return np.stack(cols, axis=-1)
+
+
+def _tps_kernel(r):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = r*r*np.log(r)
+    return np.nan_to_num(k)
+
+
+class FocusMap(object):
+
+    models = ('plane', 'quadratic', 'tps')
+
+    def __init__(self, fname=None, model='plane', outlier_sigma=3.0, smoothing=1e-3):
+        self.fname = fname
+        self.model = model
+        self.outlier_sigma = outlier_sigma
+        self.smoothing = smoothing
+        self.points = np.zeros((0, 4)) # x, y, wd, time
+        self.inliers = np.zeros(0, dtype=bool)
+        self.coef = None
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def __len__(self):
+        return len(self.points)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with open(self.fname, 'r') as f:
+            d = json.load(f)
+        self.model = d.get('model', self.model)
+        self.points = np.array(d['points'], dtype=float).reshape(-1, 4)
+        self.fit()
+
+    def save(self):
+        if not self.fname:
+            return
+        save_json(self.fname, dict(model=self.model, points=self.points.tolist(),
+                                   inliers=self.inliers.tolist()), indent=1)
+
+    def add(self, x, y, wd):
+        self.points = np.vstack([self.points, [x, y, wd, time.time()]])
+        self.fit()
+        self.save()
+
+    def clear(self):
+        self.points = np.zeros((0, 4))
+        self.fit()
+        self.save()
+
+    def reject_outliers(self):
+        x, y, z = self.points[:, 0], self.points[:, 1], self.points[:, 2]
+        n = len(z)
+        order = 2 if n >= 8 else 1
+        inliers = np.ones(n, dtype=bool)
+        if n < 4:
+            return inliers
+        for i in range(5):
+            A = _design(x, y, order)
+            c, *_ = np.linalg.lstsq(A[inliers], z[inliers], rcond=None)
+            r = z - A @ c
+            mad = np.median(np.abs(r[inliers] - np.median(r[inliers])))
+            if mad <= 0:
+                break
+            new = np.abs(r) <= self.outlier_sigma * 1.4826 * mad
+            if new.sum() < 3 or np.array_equal(new, inliers):
+                break
+            inliers = new
+        return inliers
+
+    def fit(self):
+        n = len(self.points)
+        self.coef = None
+        self.inliers = np.zeros(n, dtype=bool)
+        if n == 0:
+            return
+        self.inliers = self.reject_outliers()
+        x, y, z = self.points[self.inliers, :3].T
+        model = self.model
+        if model == 'quadratic' and len(z) < 6:
+            model = 'plane'
+        if model == 'tps' and len(z) < 4:
+            model = 'plane'
+        if model == 'plane' and len(z) < 3:
+            # one or two points, constant WD
+            self.coef = ('const', float(z.mean()))
+            return
+        if model in ('plane', 'quadratic'):
+            order = 2 if model == 'quadratic' else 1
+            c, *_ = np.linalg.lstsq(_design(x, y, order), z, rcond=None)
+            self.coef = (model, c)
+            return
+        # thin plate spline, smoothing scaled to point spread
+        xy = np.stack([x, y], axis=1)
+        K = _tps_kernel(np.hypot(*(xy[:, None, :] - xy[None, :, :]).transpose(2, 0, 1)))
+        P = _design(x, y, 1)
+        m = len(z)
+        L = np.zeros((m + 3, m + 3))
+        L[:m, :m] = K + self.smoothing*np.eye(m)
+        L[:m, m:] = P
+        L[m:, :m] = P.T
+        sol = np.linalg.lstsq(L, np.concatenate([z, np.zeros(3)]), rcond=None)[0]
+        self.coef = ('tps', (xy, sol[:m], sol[m:]))
+
+    def predict(self, x, y):
+        'WD (mm) at stage x, y (arrays or scalars), None if map is empty'
+        if self.coef is None:
+            return None
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        kind, c = self.coef
+        if kind == 'const':
+            out = np.full(np.broadcast(x, y).shape, c)
+        elif kind in ('plane', 'quadratic'):
+            out = _design(x, y, 2 if kind == 'quadratic' else 1) @ c
+        else:
+            xy, w, a = c
+            r = np.hypot(x[..., None] - xy[:, 0], y[..., None] - xy[:, 1])
+            out = _tps_kernel(r) @ w + _design(x, y, 1) @ a
+        return float(out) if out.ndim == 0 else out
@@ -0,0 +1,150 @@
+'''
+Working distance / stigmation sweep for Remcon32
+
+Steps through a grid of WD and stig values, grabs a frame at each point with a
+user supplied acquire function and scores it. Scoring of a frame runs on a
+worker thread while the next setpoint is sent and settles. The grid is refined
+around the best point coarse-to-fine.
+'''
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+'''
+sharpness metrics, larger is sharper, normalized by mean so they do not
+follow brightness changes during the sweep
+'''
+def sharpness_gradient(img):
+    img = np.asarray(img, dtype=np.float32)
+    gx = np.diff(img, axis=1)
+    gy = np.diff(img, axis=0)
+    m = img.mean()
+    return float(((gx*gx).mean() + (gy*gy).mean()) / (m*m + 1e-12))
+
+def sharpness_laplacian(img):
+    img = np.asarray(img, dtype=np.float32)
+    lap = (img[1:-1, :-2] + img[1:-1, 2:] + img[:-2, 1:-1] + img[2:, 1:-1]
+           - 4*img[1:-1, 1:-1])
+    m = img.mean()
+    return float(lap.var() / (m*m + 1e-12))
+
+def sharpness_variance(img):
+    img = np.asarray(img, dtype=np.float32)
+    m = img.mean()
+    return float(img.var() / (m + 1e-12))
+
+sharpness_metrics = {'gradient': sharpness_gradient,
+                     'laplacian': sharpness_laplacian,
+                     'variance': sharpness_variance}
+
+
+class FocusSweep(object):
+
+    wd_limits = (0.0, 50.0)        # mm, same as Remcon32.set_wd
+    stig_limits = (-100.0, 100.0)  # %
+
+    def __init__(self, remcon, acquire_func, score_func='gradient', settle_time=0.2):
+        '''
+        remcon: Remcon32 instance
+        acquire_func: called with no arguments, returns a 2D frame
+        score_func: name in sharpness_metrics or callable frame -> float
+        settle_time: s to wait after a setpoint is acknowledged before acquiring
+        '''
+        self.remcon = remcon
+        self.acquire_func = acquire_func
+        if not callable(score_func):
+            score_func = sharpness_metrics[score_func]
+        self.score_func = score_func
+        self.settle_time = settle_time
+
+    def _timed_score(self, frame):
+        t0 = time.perf_counter()
+        score = self.score_func(frame)
+        return score, time.perf_counter() - t0
+
+    def run_grid(self, wd_values, stig_x_values, stig_y_values, timing):
+        '''
+        one pass over the grid, returns list of (wd, stig_x, stig_y, score)
+        '''
+        R = self.remcon
+        points = list(itertools.product(wd_values, stig_x_values, stig_y_values))
+        futures = []
+        last_wd, last_stig = None, None
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            for wd, sx, sy in points:
+                t0 = time.perf_counter()
+                # only send what changed, WD is the outer loop so most steps are stig only
+                if wd != last_wd:
+                    R.set_wd(wd)
+                    last_wd = wd
+                if (sx, sy) != last_stig:
+                    R.set_stig(sx, sy)
+                    last_stig = (sx, sy)
+                t1 = time.perf_counter()
+                # previous frame is being scored on the worker meanwhile
+                time.sleep(self.settle_time)
+                t2 = time.perf_counter()
+                frame = self.acquire_func()
+                t3 = time.perf_counter()
+                futures.append(pool.submit(self._timed_score, frame))
+                timing['set'] += t1 - t0
+                timing['settle'] += t2 - t1
+                timing['acquire'] += t3 - t2
+            t0 = time.perf_counter()
+            results = [f.result() for f in futures]
+            timing['score_wait'] += time.perf_counter() - t0
+        timing['score'] += sum(dt for score, dt in results)
+        timing['n_frames'] += len(points)
+        return [(wd, sx, sy, score) for (wd, sx, sy), (score, dt) in zip(points, results)]
+
+    def run(self, wd_values, stig_x_values=None, stig_y_values=None,
+            n_refine=2, refine_factor=0.3, apply_best=True):
+        '''
+        wd_values, stig_x_values, stig_y_values: 1D sequences for the first (coarse) pass
+            stig values default to current stig, ie WD only sweep
+        n_refine: number of additional passes on a grid shrunk by refine_factor
+            around the best point of the previous pass
+        returns dict with best wd, stig_x, stig_y, score, all scored points and timing (s)
+        '''
+        R = self.remcon
+        if stig_x_values is None or stig_y_values is None:
+            stig = R.get_stig()
+            if stig_x_values is None:
+                stig_x_values = [float(stig[0])]
+            if stig_y_values is None:
+                stig_y_values = [float(stig[1])]
+        axes = [np.asarray(wd_values, dtype=float),
+                np.asarray(stig_x_values, dtype=float),
+                np.asarray(stig_y_values, dtype=float)]
+        limits = [self.wd_limits, self.stig_limits, self.stig_limits]
+
+        timing = dict(set=0.0, settle=0.0, acquire=0.0, score=0.0, score_wait=0.0, n_frames=0)
+        t_start = time.perf_counter()
+        history = []
+        best = None
+        for i in range(n_refine + 1):
+            points = self.run_grid(*axes, timing=timing)
+            history.extend(points)
+            best = max(history, key=lambda p: p[3])
+            # shrink each swept axis around best, single valued axes stay fixed
+            new_axes = []
+            for values, center, (vmin, vmax) in zip(axes, best[:3], limits):
+                if len(values) < 2:
+                    new_axes.append(values)
+                    continue
+                half_span = 0.5*refine_factor*(values.max() - values.min())
+                lo = max(vmin, center - half_span)
+                hi = min(vmax, center + half_span)
+                new_axes.append(np.linspace(lo, hi, len(values)))
+            axes = new_axes
+
+        wd, sx, sy, score = best
+        if apply_best:
+            R.set_wd(wd)
+            R.set_stig(sx, sy)
+        timing['total'] = time.perf_counter() - t_start
+        return dict(wd=wd, stig_x=sx, stig_y=sy, score=score,
+                    points=np.array(history), timing=timing)
@@ -0,0 +1,46 @@
+'''
+FFT phase correlation between two frames, subpixel by parabolic peak fit
+'''
+import numpy as np
+
+
+def hann_window(shape):
+    wy = np.hanning(shape[0])
+    wx = np.hanning(shape[1])
+    return np.outer(wy, wx).astype(np.float32)
+
+
+def _parabolic_offset(c_minus, c0, c_plus):
+    denom = c_minus - 2*c0 + c_plus
+    if denom == 0:
+        return 0.0
+    return 0.5*(c_minus - c_plus)/denom
+
+
+def estimate_shift(ref, img, window=True):
+    '''
+    returns (dx, dy, peak): displacement of img features relative to ref, in pixels
+    (x along columns, y along rows), and the normalized correlation peak height
+    (close to 1 for a clean match, small for no match)
+    '''
+    ref = np.asarray(ref, dtype=np.float32)
+    img = np.asarray(img, dtype=np.float32)
+    ref = ref - ref.mean()
+    img = img - img.mean()
+    if window:
+        w = hann_window(ref.shape)
+        ref = ref*w
+        img = img*w
+    cross = np.fft.fft2(img) * np.conj(np.fft.fft2(ref))
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.ifft2(cross).real
+
+    ny, nx = corr.shape
+    iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+    peak = float(corr[iy, ix])
+    sub_y = _parabolic_offset(corr[(iy-1) % ny, ix], corr[iy, ix], corr[(iy+1) % ny, ix])
+    sub_x = _parabolic_offset(corr[iy, (ix-1) % nx], corr[iy, ix], corr[iy, (ix+1) % nx])
+    # wrap to signed shifts
+    dy = iy - ny if iy > ny//2 else iy
+    dx = ix - nx if ix > nx//2 else ix
+    return dx + sub_x, dy + sub_y, peak
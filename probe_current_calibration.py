@@ -0,0 +1,131 @@
+'''
+Probe current calibration cache
+
+Beam current for each probe mode (high current on/off, Auger probe_current
+macros) at a given kV and aperture, measured with the specimen current
+monitor (prb?) and kept per instrument as json. estimate() answers from the
+cache at once; update() re-measures only when the entry is missing or older
+than max_age, or when a short drift check every check_interval disagrees
+with it by more than drift_tol.
+'''
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from .remcon_shadow_state import save_json
+
+
+def measure_scm(remcon, window=2.0, interval=0.1, scm_on=False, settle=0.5, set_scm_state=None):
+    '''
+    average remcon.get_scm over window s, returns (mean, std, n)
+    if scm_on is False the SCM is switched on for the measurement and back
+    off afterwards, with set_scm_state(bool) (default remcon.scm_state)
+    SCM on disables the touch alarm, so the measurement holds
+    remcon.stage_lock (no stage move can start) and raises IOError if the
+    stage is moving or was just commanded
+    '''
+    if set_scm_state is None:
+        set_scm_state = remcon.scm_state
+    with remcon.stage_lock:
+        move = remcon.last_stage_move
+        # motion flag lags the c95 command
+        if remcon.get_stage_moving() or (move is not None and time.time() - move[0] < 1.0):
+            raise IOError("stage moving, SCM measurement not started")
+        if not scm_on:
+            set_scm_state(True)
+            time.sleep(settle)
+        try:
+            vals = []
+            t_end = time.time() + window
+            while True:
+                vals.append(remcon.get_scm())
+                if time.time() >= t_end:
+                    break
+                time.sleep(interval)
+        finally:
+            if not scm_on:
+                set_scm_state(False)
+    vals = np.array(vals)
+    return float(vals.mean()), float(vals.std()), len(vals)
+
+
+class ProbeCurrentCalibration(object):
+
+    def __init__(self, fname=None, max_age=24*3600., check_interval=3600., drift_tol=0.1):
+        '''
+        max_age, check_interval: s, drift_tol: relative current change that fails a drift check
+        '''
+        self.fname = fname
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.drift_tol = drift_tol
+        # key -> dict(current, std, n, time, checked)
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.n_measured = 0
+        self.n_drift_failed = 0
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    @staticmethod
+    def key(mode, kV, aperture):
+        return "{}|{:.1f}|{}".format(mode, float(kV), aperture)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with open(self.fname, 'r') as f:
+            self.entries = json.load(f)
+
+    def save(self):
+        if not self.fname:
+            return
+        with self.lock:
+            save_json(self.fname, self.entries, indent=1)
+
+    def lookup(self, mode, kV, aperture):
+        return self.entries.get(self.key(mode, kV, aperture))
+
+    def age(self, entry, now=None):
+        if now is None:
+            now = time.time()
+        return now - entry['time']
+
+    def estimate(self, mode, kV, aperture):
+        'cached current (A) or None, no hardware access'
+        entry = self.lookup(mode, kV, aperture)
+        return None if entry is None else entry['current']
+
+    def record(self, mode, kV, aperture, current, std, n):
+        now = time.time()
+        with self.lock:
+            self.entries[self.key(mode, kV, aperture)] = dict(
+                current=current, std=std, n=n, time=now, checked=now)
+        self.save()
+
+    def update(self, mode, kV, aperture, measure_func, check_fraction=0.25):
+        '''
+        measure_func(window_fraction) -> (mean, std, n), window_fraction 1 for a
+        full measurement, check_fraction for a drift check
+        returns (current, action) with action one of 'cached', 'checked', 'measured'
+        '''
+        entry = self.lookup(mode, kV, aperture)
+        now = time.time()
+        if entry is not None and self.age(entry, now) < self.max_age:
+            if now - entry['checked'] < self.check_interval:
+                return entry['current'], 'cached'
+            current, std, n = measure_func(check_fraction)
+            ref = entry['current']
+            if abs(current - ref) <= self.drift_tol*max(abs(ref), 1e-15):
+                with self.lock:
+                    entry['checked'] = now
+                self.save()
+                return ref, 'checked'
+            self.n_drift_failed += 1
+        current, std, n = measure_func(1.0)
+        self.n_measured += 1
+        self.record(mode, kV, aperture, current, std, n)
+        return current, 'measured'
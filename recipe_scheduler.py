@@ -0,0 +1,190 @@
+'''
+Recipe switching costs and job ordering
+
+RecipeSwitchCost estimates the time to go from one SEMRecipeControlMeasure
+recipe to another: the EHT ramp (EHTSettleTracker prediction) runs in
+parallel with the other setting writes, which are sequential and timed per
+setting from recipe executions. schedule_jobs orders a job list to minimize
+total switching time, nearest neighbour start then 2-opt over the cost
+matrix. Higher priority jobs always run before lower priority ones, and
+within a priority level a reorder is only kept if it does not make deadlines
+later.
+
+A job is a dict: recipe (name), duration (s) and optionally
+priority (higher runs first, default 0) and deadline (s from start).
+'''
+import json
+import os
+import threading
+
+import numpy as np
+
+from .remcon_shadow_state import save_json
+
+
+class RecipeSwitchCost(object):
+
+    # s per change, starting guesses until timed: macros are slow, plain writes fast
+    default_times = {'select_aperture': 3.0, 'high_current': 3.0,
+                     'WD': 0.2, 'stig_x': 0.1, 'stig_y': 0.1,
+                     'aperture_x': 0.1, 'aperture_y': 0.1,
+                     'gun_x': 0.1, 'gun_y': 0.1}
+
+    def __init__(self, eht_tracker=None, fname=None, alpha=0.2):
+        '''
+        eht_tracker: EHTSettleTracker used for kV ramp time, None for a fixed 2 kV/s
+        alpha: weight of a new timing in the running average
+        '''
+        self.eht_tracker = eht_tracker
+        self.fname = fname
+        self.alpha = alpha
+        self.times = dict(self.default_times)
+        self.lock = threading.Lock()
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with open(self.fname, 'r') as f:
+            self.times.update(json.load(f))
+
+    def save(self):
+        if not self.fname:
+            return
+        save_json(self.fname, self.times, indent=1)
+
+    def record(self, name, duration):
+        'timed change of one recipe setting'
+        with self.lock:
+            old = self.times.get(name)
+            if old is None:
+                self.times[name] = float(duration)
+            else:
+                self.times[name] = (1 - self.alpha)*old + self.alpha*float(duration)
+
+    def kV_time(self, from_kV, to_kV):
+        if from_kV == to_kV:
+            return 0.0
+        if self.eht_tracker is None:
+            return 0.5 + abs(to_kV - from_kV) / 2.0
+        return self.eht_tracker.predict(from_kV, to_kV)
+
+    def cost(self, a, b):
+        'switch time (s) from recipe dict a to recipe dict b'
+        if a is None:
+            return 0.0
+        writes = 0.0
+        for name, t in self.times.items():
+            if name in a and name in b and not _same(a[name], b[name]):
+                writes += t
+        return max(self.kV_time(float(a['kV']), float(b['kV'])), writes)
+
+    def matrix(self, recipes):
+        'N x N switch times between recipe dicts'
+        n = len(recipes)
+        C = np.zeros((n, n))
+        for i in range(n):
+            for j in range(n):
+                if i != j:
+                    C[i, j] = self.cost(recipes[i], recipes[j])
+        return C
+
+
+def _same(a, b):
+    try:
+        return abs(float(a) - float(b)) < 1e-9
+    except (TypeError, ValueError):
+        return str(a) == str(b)
+
+
+def _evaluate(order, r, dur, deadline, C, r0):
+    '''
+    switch time and total lateness of jobs run in order,
+    r: job recipe index, r0: starting recipe index or -1
+    '''
+    rec = r[order]
+    prev = np.concatenate([[r0], rec[:-1]])
+    sw = np.where(prev < 0, 0.0, C[np.maximum(prev, 0), rec])
+    finish = np.cumsum(sw + dur[order])
+    late = np.clip(finish - deadline[order], 0, None).sum()
+    return sw.sum(), late
+
+
+def _nearest_neighbour(jobs, r, C, r_cur):
+    left = list(jobs)
+    out = []
+    while left:
+        if r_cur < 0:
+            k = 0
+        else:
+            k = int(np.argmin(C[r_cur, r[left]]))
+        j = left.pop(k)
+        out.append(j)
+        r_cur = r[j]
+    return out
+
+
+def _two_opt(order, r, dur, deadline, C, r0, t_offset, max_passes=20):
+    order = np.array(order)
+    dl = deadline - t_offset
+    best = _evaluate(order, r, dur, dl, C, r0)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(order) - 1):
+            for k in range(i + 1, len(order)):
+                trial = order.copy()
+                trial[i:k+1] = trial[i:k+1][::-1]
+                sw, late = _evaluate(trial, r, dur, dl, C, r0)
+                if late <= best[1] + 1e-9 and sw < best[0] - 1e-9:
+                    order, best = trial, (sw, late)
+                    improved = True
+        if not improved:
+            break
+    return list(order)
+
+
+def schedule_jobs(jobs, recipes, cost_model, start_recipe=None):
+    '''
+    jobs: list of job dicts, recipes: {name: recipe dict}
+    start_recipe: recipe dict the microscope is in now, None if unknown
+    returns (ordered jobs, report dict with baseline_switch_time,
+             switch_time, time_saved, lateness)
+    '''
+    if not jobs:
+        return [], dict(baseline_switch_time=0.0, switch_time=0.0, time_saved=0.0, lateness=0.0)
+    names = sorted(set(j['recipe'] for j in jobs))
+    rlist = [recipes[name] for name in names]
+    if start_recipe is not None:
+        rlist.append(start_recipe)
+    C = cost_model.matrix(rlist)
+    r0 = len(names) if start_recipe is not None else -1
+    r = np.array([names.index(j['recipe']) for j in jobs])
+    dur = np.array([float(j.get('duration', 0.0)) for j in jobs])
+    deadline = np.array([np.inf if j.get('deadline') is None else float(j['deadline'])
+                         for j in jobs])
+    priority = np.array([j.get('priority', 0) for j in jobs])
+
+    order = []
+    r_cur = r0
+    t = 0.0
+    for p in sorted(set(priority), reverse=True):
+        # submission order within the level is the fallback if nothing beats it
+        group = [i for i in range(len(jobs)) if priority[i] == p]
+        dl = deadline - t
+        candidates = [group, _nearest_neighbour(group, r, C, r_cur),
+                      sorted(group, key=lambda i: deadline[i])]
+        scores = [_evaluate(np.array(c), r, dur, dl, C, r_cur) for c in candidates]
+        start = candidates[min(range(3), key=lambda k: (scores[k][1], scores[k][0]))]
+        group_order = _two_opt(start, r, dur, deadline, C, r_cur, t)
+        sw, late = _evaluate(np.array(group_order), r, dur, dl, C, r_cur)
+        t += sw + dur[group_order].sum()
+        r_cur = r[group_order[-1]]
+        order += group_order
+
+    baseline, base_late = _evaluate(np.arange(len(jobs)), r, dur, deadline, C, r0)
+    switch, late = _evaluate(np.array(order), r, dur, deadline, C, r0)
+    report = dict(baseline_switch_time=float(baseline), switch_time=float(switch),
+                  time_saved=float(baseline - switch), lateness=float(late),
+                  baseline_lateness=float(base_late))
+    return [jobs[i] for i in order], report
@@ -6,11 +6,13 @@ Significant changes for python 3 Frank 3/15/17
 Thicker wrapper, some commands left out on purpose (gun off for example)
 '''
 import serial
-import numpy as np
 import time
 from collections import OrderedDict
 import threading
 
+from .remcon_trace import tracer
+from .remcon_batch import RemconBatch
+
 class Remcon32(object):
     
     #direct serial communications, Zeiss Remcon32 response parsing++++++++++++++++++++++++++++++++
@@ -21,15 +23,51 @@ class Remcon32(object):
         '''
         self.timeout = 0.50    #readline called twice, timeout only for comm errors
         self.port=port
+        self.lock = threading.RLock() #reentrant, callers may hold it across several commands
+        self.batch_program = None #RemconBatch queueing set commands, see batch()
+        #held while sending a stage move, and by anything that must not overlap one (eg SCM on)
+        self.stage_lock = threading.Lock()
+        #online is cleared when the link drops, commands then fail fast until reopen()
+        self.online = False
+        #called (from the failing thread) when the link drops, eg to start a reconnect
+        self.link_lost_callback = None
+        #last c95? reading and last c95 move (time.time(), start pose, target pose), for move-time models
+        self.last_stage_position = None
+        self.last_stage_move = None
+        #trace span of the last move, ended by whoever sees the stage stop
+        self.stage_move_span = None
+        self.open()
+        
+    def open(self):
         self.ser = serial.Serial(port=self.port, baudrate=9600, 
                                     bytesize= serial.EIGHTBITS, parity=serial.PARITY_NONE, 
                                     stopbits=serial.STOPBITS_ONE, timeout=self.timeout)
-        self.lock = threading.Lock()
-        
+        self.online = True
     
     def close(self):
+        self.online = False
         self.ser.close()
         
+    def reopen(self):
+        '''
+        close and reopen serial port after Remcon32 console restart or adapter drop out
+        raises IOError (SerialException) if port is still unavailable
+        '''
+        with self.lock:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.open()
+            
+    def _link_lost(self, cmd, err):
+        #mark offline so other callers fail fast instead of each waiting for timeout
+        was_online = self.online
+        self.online = False
+        if was_online and self.link_lost_callback is not None:
+            self.link_lost_callback()
+        raise IOError('remcon link lost, command: {} {}'.format(cmd, err))
+        
     remcon_error = {600: 'Unknown command',
                     601: 'Invalid number of parameters',
                     602: 'Invalid parameter type',
@@ -48,17 +86,43 @@ class Remcon32(object):
         sends bytestring terminated by \r to Remcon32 program, parses return values
         some commands like read scm return errors if the scm is off, likewise out of range arguments
             if error_ok is set, this info returned instead of throwing errors
+        inside a batch() set commands are queued, see remcon_batch
         '''
-        with self.lock:
-            self.ser.reset_input_buffer()    #clear any leftover stuff
-            cmd = cmd.encode('ascii') + b'\r'
-            self.ser.write(cmd)
-    
-            r1 =self.ser.readline() #is '@\r\n' for success or '#\r\n' for failure
-            r2 =self.ser.readline() 
-            #is '>[data]\r\n' for success or '* errnum\r\n' for failure
-            #[data] may be empty for set commands, returns info for get
+        program = self.batch_program
+        if program is not None:
+            return program.submit(cmd, error_ok)
+        return self.send_cmd(cmd, error_ok)
 
+    def batch(self, window=None):
+        'context manager queueing and optimizing set commands, see remcon_batch'
+        return RemconBatch(self, window=window)
+
+    def send_cmd(self, cmd, error_ok=False):
+        'cmd_response without batching'
+        if not self.online:
+            raise IOError('remcon link down, command not sent: {}'.format(cmd))
+        with tracer.span('cmd_response', 'serial', cmd=cmd):
+            with tracer.span('lock_wait', 'serial'):
+                self.lock.acquire()
+            try:
+                cmd = cmd.encode('ascii') + b'\r'
+                try:
+                    self.ser.reset_input_buffer()    #clear any leftover stuff
+                    self.ser.write(cmd)
+            
+                    r1 =self.ser.readline() #is '@\r\n' for success or '#\r\n' for failure
+                    r2 =self.ser.readline() 
+                    #is '>[data]\r\n' for success or '* errnum\r\n' for failure
+                    #[data] may be empty for set commands, returns info for get
+                except serial.SerialException as err:
+                    #adapter unplugged or port closed under us
+                    self._link_lost(cmd, err)
+            finally:
+                self.lock.release()
+
+        if len(r1) < 1:
+            #no reply at all within timeout, console not running
+            self._link_lost(cmd, 'no response')
         if ( (len(r1)<1) or (r1[0]!=ord(b'@')) or (len(r2)<1) or (r2[0]!=ord(b'>')) ):
             if error_ok:
                 return r2.decode('ascii')
@@ -118,6 +182,7 @@ class Remcon32(object):
         return self.cmd_response('stim {} {}'.format(x_val, y_val))
         
     def get_stig(self):
+        import numpy as np # imported on use, keeps headless scripts light
         resp = self.cmd_response('sti?')
         return np.fromstring(resp,sep=' ')
         
@@ -139,6 +204,7 @@ class Remcon32(object):
         
     def get_ap_xy(self):
         #value for current selected aperture'
+        import numpy as np
         resp = self.cmd_response('aln?')
         return np.fromstring(resp,sep=' ')
         
@@ -256,6 +322,26 @@ class Remcon32(object):
         self.display_focus_state(True) #focus on primary display
         return name
     
+    def set_chan_levels(self, contrast=None, bright=None, primary=True, restore_zone=True):
+        #contrast and brightness of one display with a single zone switch
+        #restore_zone=False leaves focus on that display, caller must switch back
+        self.display_focus_state(primary)
+        if contrast is not None:
+            self.set_contrast(contrast)
+        if bright is not None:
+            self.set_bright(bright)
+        if restore_zone and not primary:
+            self.display_focus_state(True) #focus on primary display
+    
+    def get_chan_levels(self, primary=True):
+        #returns contrast, brightness of one display with a single zone switch
+        self.display_focus_state(primary)
+        c = self.get_contrast()
+        b = self.get_bright()
+        if not primary:
+            self.display_focus_state(True) #focus on primary display
+        return c, b
+    
     def dual_channel_state(self,state=True):
         if state:
             self.run_macro(1) # 'DualMonitor = On'
@@ -311,7 +397,8 @@ class Remcon32(object):
         
         also SmartSem START macro runs Remcon32 in autoconnect mode
         '''
-        return self.cmd_response('mac %i' % n)
+        with tracer.span('macro', 'macro', n=n):
+            return self.cmd_response('mac %i' % n)
    
         
     '''
@@ -358,13 +445,16 @@ class Remcon32(object):
     def get_stage_position(self):
         'returns x y z tilt rot M status'
         'for 5/6 axis stage, last param is 1.0 in motion, 0.0 done'
+        import numpy as np
         resp = self.cmd_response('c95?')
         resp_array = np.fromstring(resp,sep=' ', dtype=float) #array of 7 floats
+        self.last_stage_position = resp_array
         print("get_stage_position -->", resp_array)
         return resp_array
     
     def get_stage_initialized_state(self):
         'returns stage type (int) and is_initialized (int, 0 = initialized, 1 = NOT)'
+        import numpy as np
         resp = self.cmd_response('ist?')
         status = np.fromstring(resp,sep=' ', dtype=int)
         if status[1]:
@@ -382,10 +472,16 @@ class Remcon32(object):
             raise IOError("REMCON Stage not initialized, cancelling move set_stage_position")
             return
         'error if out of physical limits, can be dangerous'
-        state = self.get_scm()
-        self.scm_state(False)   #turn off scm so touch alarm works!
-        cmd = 'c95 {} {} {} {} {} 0.0'.format(x,y,z,tilt,rot)
-        resp = self.cmd_response(cmd)
+        with self.stage_lock:
+            state = self.get_scm()
+            self.scm_state(False)   #turn off scm so touch alarm works!
+            cmd = 'c95 {} {} {} {} {} 0.0'.format(x,y,z,tilt,rot)
+            start = self.last_stage_position
+            self.end_stage_move_span()
+            self.stage_move_span = tracer.begin('stage_move', 'stage', target=cmd)
+            resp = self.cmd_response(cmd)
+            self.last_stage_move = (time.time(), None if start is None else list(start[:5]),
+                                    [x, y, z, tilt, rot])
         if type(resp) is float:
             self.scm_state(True) #restore scm if it returned a numerical value (else error string)
         return resp
@@ -397,6 +493,11 @@ class Remcon32(object):
 #         print(pos)
 #         return self.set_stage_position(pos['x'], pos['y'], pos['z'], pos['tilt'], pos['rot'])
             
+    def end_stage_move_span(self):
+        span, self.stage_move_span = self.stage_move_span, None
+        if span is not None:
+            span.end()
+
     def set_stage_position_kwargs(self, x=None, y=None,z=None,tilt=None, rot=None):
         print("set_stage_position_kwargs", x, y,z, tilt, rot)
         pos = self.get_stage_position_dict()
@@ -10,7 +10,27 @@ Revised by Alan Buckley
 
 from ScopeFoundry import HardwareComponent
 from .remcon32 import Remcon32
+from .remcon_shadow_state import RemconShadowState
+from .focus_sweep import FocusSweep
+from .spot_scan import SpotScanEngine
+from .remcon_coalesce import CoalescedWriter
+from .beam_shift_calibration import BeamShiftCalibration
+from .drift_correction import DriftCorrector
+from .eht_settle import EHTSettleTracker
+from .alignment_calibration import AlignmentCalibration
+from .auto_contrast import AutoContrast
+from .telemetry import TelemetryRecorder
+from .remcon_snapshot import RemconSnapshot
+from .stage_motion_model import StageMotionModel
+from .focus_map import FocusMap
+from .stage_envelope import StageEnvelope
+from .probe_current_calibration import ProbeCurrentCalibration, measure_scm
+from .remcon_trace import tracer
+import numpy as np
 import configparser
+from concurrent.futures import Future
+import os
+import threading
 import time
 
 
@@ -19,6 +39,30 @@ class SEM_Remcon_HW(HardwareComponent):
     
     name = 'sem_remcon'
     
+    # re-read after a reconnect, anything the console may have changed while we were away
+    reconcile_read_settings = ('eht_on', 'kV', 'beam_blanking', 'external_scan',
+                               'magnification', 'WD', 'stig_xy', 'aperture_xy',
+                               'select_aperture', 'stage_position', 'stage_initialized')
+    # cannot be read back, values come from shadow state and are re-applied after a reconnect
+    write_only_settings = ('gun_xy', 'beamshift_xy', 'high_current', 'dual_channel')
+    # spin box / slider driven, only the newest value is written while a write is in flight
+    coalesced_settings = ('stig_xy', 'aperture_xy', 'WD', 'magnification')
+    # recorded on every change when telemetry is enabled
+    telemetry_settings = ('kV', 'eht_on', 'beam_blanking', 'magnification', 'WD',
+                          'stage_position', 'scm_state', 'scm_current',
+                          'detector0', 'detector1', 'contrast0', 'contrast1',
+                          'stig_xy', 'aperture_xy', 'select_aperture', 'high_current',
+                          'gun_xy', 'beamshift_xy')
+    # read by snapshot() unless read more recently than snapshot_max_age
+    snapshot_read_settings = ('kV', 'eht_on', 'beam_blanking', 'external_scan',
+                              'magnification', 'WD', 'stig_xy', 'aperture_xy', 'stage_position')
+    # only change through this app (or cost zone switching macros to read), cached values are used
+    snapshot_cached_settings = ('SEM_mode', 'select_aperture', 'full_size',
+                                'detector0', 'detector1', 'contrast0', 'contrast1',
+                                'gun_xy', 'beamshift_xy', 'high_current', 'dual_channel', 'scm_state')
+    # polled every telemetry_period by threaded_update, others change through the app or are polled anyway
+    telemetry_poll_settings = ('kV', 'WD')
+    
      
     def setup(self):
         self.debug=False
@@ -136,23 +180,139 @@ class SEM_Remcon_HW(HardwareComponent):
 
         self.settings.New('stage_initialized', dtype=bool, ro=True)
         
+        # automatic reconnect when Remcon32 console restarts or serial adapter drops out
+        self.settings.New('auto_reconnect', dtype=bool, initial=True)
+        self.settings.New('reconnect_max_backoff', dtype=float, initial=30.0, vmin=0.5, unit='s')
+        self.settings.New('link_state', dtype=str, initial='disconnected', ro=True)
+        
+        # persisted shadow copy of write-only settings, see write_only_settings
+        self.settings.New('shadow_state_file', dtype='file', initial='remcon_shadow_state.json')
+        self.settings.New('shadow_suppress_writes', dtype=bool, initial=True,
+                          description='skip writes of values already applied (avoids re-running slow macros)')
+        
+        # write coalescing, see coalesced_settings
+        self.settings.New('coalesce_writes', dtype=bool, initial=True)
+        self.settings.New('write_min_interval', dtype=float, initial=0.0, vmin=0.0, unit='s',
+                          description='optional rate limit for coalesced writes')
+        self.settings.New('coalesced_writes_dropped', dtype=int, initial=0, ro=True)
+        
+        # EHT ramp tracking, see wait_for_kV
+        self.settings.New('eht_history_file', dtype='file', initial='eht_settle_history.json')
+        self.settings.New('eht_settle_tol', dtype=float, initial=0.05, vmin=0.001, unit='kV')
+        
+        # kV/WD indexed alignment table, see apply_alignment
+        self.settings.New('align_calib_file', dtype='file', initial='alignment_calibration.csv')
+        self.settings.New('auto_align', dtype=bool, initial=False,
+                          description='apply interpolated stig/aperture/gun alignment when kV or WD change')
+        
+        # telemetry archive, see TelemetryRecorder
+        self.settings.New('telemetry_enabled', dtype=bool, initial=False)
+        self.settings.New('telemetry_path', dtype='file', is_dir=True, initial='remcon_telemetry')
+        self.settings.New('telemetry_period', dtype=float, initial=10.0, vmin=0.5, unit='s')
+        
+        self.settings.New('snapshot_max_age', dtype=float, initial=1.0, vmin=0.0, unit='s',
+                          description='snapshot() re-reads values older than this')
+        self.settings.New('snapshot_latency', dtype=float, initial=0.0, ro=True, unit='s')
+        
+        # learned stage move times, see wait_until_stage_stopped
+        self.settings.New('stage_model_file', dtype='file', initial='stage_motion_model.json')
+        self.settings.New('stage_move_eta', dtype=float, initial=0.0, ro=True, unit='s')
+        self.settings.New('stage_fault_factor', dtype=float, initial=2.0, vmin=1.0,
+                          description='flag a move taking longer than this times its predicted duration')
+        self.settings.New('stage_move_fault', dtype=bool, initial=False, ro=True)
+        self.settings.New('stage_envelope_file', dtype='file', initial='stage_envelope.ini',
+                          description='chamber / holder collision envelope used by safe_move')
+        
+        # stage xy -> WD focus map, see apply_focus_map
+        self.settings.New('focus_map_enabled', dtype=bool, initial=False,
+                          description='set WD from focus map after each stage move')
+        self.settings.New('focus_map_file', dtype='file', initial='focus_map.json')
+        self.settings.New('focus_map_model', dtype=str, initial='plane', choices=FocusMap.models)
+        self.settings.New('focus_map_points', dtype=int, initial=0, ro=True)
+        
+        # hybrid beam shift / stage positioning, see move_field
+        self.settings.New('beamshift_calib_file', dtype='file', initial='beamshift_calibration.json')
+        self.settings.New('beamshift_limit', dtype=float, initial=90.0, vmin=0, vmax=100, unit=r'%',
+                          description='largest beam shift used by move_field before falling back to stage')
+        
+        # timeline of serial commands, macros and waits, see export_trace
+        self.settings.New('trace_enabled', dtype=bool, initial=False)
+        self.settings.New('trace_file', dtype='file', initial='remcon_trace.json')
+        
+        # beam current per probe mode, kV and aperture, see calibrate_probe_current
+        self.settings.New('probe_cal_enabled', dtype=bool, initial=False,
+                          description='measure beam current with the SCM after probe mode changes')
+        self.settings.New('probe_cal_file', dtype='file', initial='probe_current_calibration.json')
+        self.settings.New('probe_cal_window', dtype=float, initial=2.0, vmin=0.1, unit='s')
+        self.settings.New('probe_cal_max_age', dtype=float, initial=24.0, vmin=0.0, unit='h')
+        self.settings.New('probe_cal_tol', dtype=float, initial=0.1, vmin=0.0,
+                          description='relative change that fails a drift check')
+        self.settings.New('probe_current_estimate', dtype=float, initial=0.0, ro=True, si=True, unit='A')
+        
         self.running_on_new_full_size = False
+        
+        self.shadow = RemconShadowState()
+        # unwrapped write functions of write-only settings, used to force re-apply
+        self.shadow_write_funcs = dict()
+        # name -> CoalescedWriter
+        self.write_coalescers = dict()
+        self.beamshift_calib = BeamShiftCalibration()
+        self.drift_corrector = None
+        self.eht_tracker = EHTSettleTracker()
+        self.align_calib = AlignmentCalibration()
+        self.telemetry = None
+        self.telemetry_last_poll = 0.0
+        # name -> time.time() of last hardware read
+        self.read_times = dict()
+        self.stage_model = StageMotionModel()
+        self.stage_move_lock = threading.Lock()
+        self.stage_was_moving = False
+        self.stage_envelope = StageEnvelope()
+        self.focus_map = FocusMap()
+        self.settings.focus_map_file.add_listener(self.load_focus_map)
+        self.settings.focus_map_model.add_listener(self.on_focus_map_model)
+        for name in self.telemetry_settings:
+            self.settings.get_lq(name).add_listener(
+                lambda name=name: self.on_telemetry_value(name))
+        self.settings.telemetry_enabled.add_listener(self.on_telemetry_enabled)
+        self.settings.trace_enabled.add_listener(self.on_trace_enabled)
+        self.probe_cal = ProbeCurrentCalibration()
+        self.probe_cal_thread = None
+        self.probe_cal_pending = False
+        for name in ('kV', 'select_aperture', 'high_current'):
+            self.settings.get_lq(name).add_listener(self.update_probe_estimate)
+        # (time.time(), from_kV, to_kV) of last kV write
+        self.kV_ramp = None
+        # (kV_ramp, Future) shared by everyone waiting on that ramp, so it is recorded once
+        self.kV_ramp_future = None
+        self.kV_ramp_lock = threading.Lock()
+        self.reconnect_thread = None
+        self.reconnect_stop = threading.Event()
     
     def on_change_control_beamshift(self):
         print('control beamshift',self.settings['control_beamshift'])
         if self.settings['control_beamshift']:
             self.settings.beamshift_xy.connect_to_hardware(
-                write_func=lambda XY: self.remcon.set_beam_shift(*XY)
+                read_func=self.shadow_read('beamshift_xy'),
+                write_func=self.shadow_write('beamshift_xy', lambda XY: self.remcon.set_beam_shift(*XY))
                 )
         else:
             self.settings.beamshift_xy.disconnect_from_hardware()      
     
     def on_new_mag(self):
         if hasattr(self, 'remcon') and not self.running_on_new_full_size:            
+            if self.coalesced_write_pending('magnification'):
+                return # pixel size is stale until the write lands, on_mag_written updates it
+            self.settings.full_size.update_value(1024 * self.remcon.get_pixel_size())
+            
+    def on_mag_written(self, val):
+        if not self.running_on_new_full_size:
             self.settings.full_size.update_value(1024 * self.remcon.get_pixel_size())
         
     def on_new_full_size(self):
         if hasattr(self, 'remcon'):
+            if 'magnification' in self.write_coalescers:
+                self.write_coalescers['magnification'].flush(timeout=2.0)
             # SEM pixel size is always image_width / 1024, regardless of actual resolution
             old_mag = self.settings['magnification']
             old_pixel = self.remcon.get_pixel_size()
@@ -164,14 +324,180 @@ class SEM_Remcon_HW(HardwareComponent):
             self.running_on_new_full_size = False
             
                    
+    def on_telemetry_enabled(self):
+        if self.settings['telemetry_enabled']:
+            if self.telemetry is None:
+                self.telemetry = TelemetryRecorder(self.settings['telemetry_path'])
+                for name in self.telemetry_settings:
+                    self.on_telemetry_value(name)
+        elif self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+
+    def on_telemetry_value(self, name):
+        T = self.telemetry
+        if T is not None:
+            T.record(name, self.settings[name])
+            
+    def telemetry_query(self, name, t_start=None, t_end=None):
+        '''
+        recorded values of setting name between t_start and t_end (time.time() seconds)
+        returns t, values numpy arrays
+        '''
+        T = self.telemetry or TelemetryRecorder(self.settings['telemetry_path'])
+        return T.query(name, t_start, t_end)
+
+    def telemetry_poll(self):
+        self.telemetry_last_poll = time.time()
+        for name in self.telemetry_poll_settings:
+            self.settings.get_lq(name).read_from_hardware()
+        if self.settings['scm_state']:
+            # prb? fails when scm is off
+            self.settings.scm_current.read_from_hardware()
+
+    def shadow_write(self, name, write_func, after_write=None):
+        '''
+        wrap write_func of a write-only setting so successful writes are
+        recorded in the shadow state, and writes of already applied values are skipped
+        after_write(val) is called after each write that was sent
+        '''
+        self.shadow_write_funcs[name] = write_func
+        def func(val):
+            if self.settings['shadow_suppress_writes'] and self.shadow.is_applied(name, val):
+                return
+            write_func(val)
+            self.shadow.record(name, val)
+            if after_write is not None:
+                after_write(val)
+        return func
+    
+    def shadow_read(self, name):
+        # read_func for write-only settings, falls back to current value if never written
+        lq = self.settings.get_lq(name)
+        return lambda: self.shadow.get(name, lq.value)
+
+    def coalesced_write(self, name, write_func, after_write=None):
+        '''
+        wrap write_func so that while a write is in flight only the newest value
+        is kept, returns immediately
+        '''
+        writer = self.write_coalescers[name] = CoalescedWriter(
+            write_func, name=name, after_write=after_write)
+        def func(val):
+            if not self.settings['coalesce_writes']:
+                writer.flush()
+                write_func(val)
+                return
+            writer.min_interval = self.settings['write_min_interval']
+            writer.submit(val)
+            self.settings['coalesced_writes_dropped'] = sum(
+                w.n_dropped for w in self.write_coalescers.values())
+        return func
+    
+    def coalesced_write_pending(self, name):
+        writer = self.write_coalescers.get(name)
+        return writer is not None and writer.busy
+    
+    def flush_writes(self, timeout=None):
+        'wait for all coalesced writes to reach the instrument'
+        for writer in list(self.write_coalescers.values()):
+            writer.flush(timeout)
+        
+    def write_metrics(self):
+        return {name: w.metrics() for name, w in self.write_coalescers.items()}
+
+    def on_link_lost(self):
+        # called by Remcon32 from whichever thread saw the failure
+        self.settings['link_state'] = 'lost'
+        self.log.warning("remcon link lost")
+        if not self.settings['auto_reconnect']:
+            return
+        if self.reconnect_thread is not None and self.reconnect_thread.is_alive():
+            return
+        self.reconnect_stop.clear()
+        self.reconnect_thread = threading.Thread(target=self.reconnect_loop, daemon=True)
+        self.reconnect_thread.start()
+        
+    def reconnect_loop(self):
+        # exponential backoff, commands fail fast in the meantime (Remcon32.online is False)
+        delay = 0.5
+        self.settings['link_state'] = 'reconnecting'
+        while not self.reconnect_stop.wait(delay):
+            try:
+                self.remcon.reopen()
+                self.remcon.get_kV() # probe, raises if console is not answering
+            except IOError as err:
+                print("remcon reconnect failed, retry in {:.1f} s: {}".format(delay, err))
+                delay = min(2*delay, self.settings['reconnect_max_backoff'])
+                continue
+            try:
+                self.reconcile_after_reconnect()
+            except IOError as err:
+                # link dropped again during reconcile, on_link_lost started nothing
+                # since this thread is still alive, so keep trying
+                print("remcon reconcile failed", err)
+                continue
+            self.settings['link_state'] = 'connected'
+            self.log.info("remcon reconnected")
+            return
+
+    def reconcile_after_reconnect(self):
+        # incremental instead of full read_from_hardware
+        S = self.settings
+        for name in self.reconcile_read_settings:
+            lq = S.get_lq(name)
+            if lq.hardware_read_func is not None:
+                self.reconcile_step(lq.read_from_hardware)
+        for name in self.write_only_settings:
+            lq = S.get_lq(name)
+            # console may have restarted with defaults, so force even if shadow says applied
+            if name in self.shadow and lq.hardware_set_func is not None:
+                self.reconcile_step(self.shadow_write_funcs[name], self.shadow.get(name))
+                
+    def reconcile_step(self, func, *args):
+        # a remcon error on one setting should not stop the others, a lost link should
+        try:
+            func(*args)
+        except IOError as err:
+            if not self.remcon.online:
+                raise
+            print("remcon reconcile", err)
+
     def connect(self, write_to_hardware=True):
+        with tracer.span('connect', 'hw', port=self.settings['port']):
+            self.connect_remcon(write_to_hardware)
+
+    def connect_remcon(self, write_to_hardware=True):
         S = self.settings
         R = self.remcon = Remcon32(port=S['port'])  
+        R.link_lost_callback = self.on_link_lost
+        S['link_state'] = 'connected'
+        self.shadow.load(S['shadow_state_file'])
+        self.eht_tracker.fname = S['eht_history_file']
+        if os.path.exists(S['eht_history_file']):
+            self.eht_tracker.load()
+        self.stage_model.fname = S['stage_model_file']
+        if os.path.exists(S['stage_model_file']):
+            self.stage_model.load()
+        self.load_focus_map()
+        self.stage_envelope = StageEnvelope(S['stage_envelope_file'])
+        if not self.stage_envelope.configured:
+            self.log.warning("no stage envelope file {}, safe_move will always lower z first".format(
+                S['stage_envelope_file']))
+        self.probe_cal.fname = S['probe_cal_file']
+        if os.path.exists(S['probe_cal_file']):
+            self.probe_cal.load()
+        self.align_calib.fname = S['align_calib_file']
+        if os.path.exists(S['align_calib_file']):
+            self.align_calib.load()
+        if os.path.exists(S['beamshift_calib_file']):
+            self.beamshift_calib.load(S['beamshift_calib_file'])
                       
         #connect logged quantity
         S.magnification.connect_to_hardware(
                 read_func = R.get_mag,
-                write_func = R.set_mag
+                write_func = self.coalesced_write('magnification', R.set_mag,
+                                                  after_write=self.on_mag_written)
                 )        
         S.eht_on.connect_to_hardware(
                 read_func = R.get_eht_state,
@@ -182,28 +508,33 @@ class SEM_Remcon_HW(HardwareComponent):
                 write_func = R.set_blank_state
                 )                
         S.dual_channel.connect_to_hardware(
-                write_func = R.dual_channel_state,
+                read_func = self.shadow_read('dual_channel'),
+                write_func = self.shadow_write('dual_channel', R.dual_channel_state),
                 )                
         S.high_current.connect_to_hardware(
-                write_func = R.high_current_state,
+                read_func = self.shadow_read('high_current'),
+                write_func = self.shadow_write('high_current', R.high_current_state,
+                                               after_write=self.on_probe_mode_written),
                 )                
         S.stig_xy.connect_to_hardware(
             read_func=R.get_stig,
-            write_func=lambda XY: R.set_stig(*XY),
+            write_func=self.coalesced_write('stig_xy', lambda XY: R.set_stig(*XY)),
             )        
         S.gun_xy.connect_to_hardware(
-            write_func=lambda XY: R.set_gun_align(*XY),
+            read_func=self.shadow_read('gun_xy'),
+            write_func=self.shadow_write('gun_xy', lambda XY: R.set_gun_align(*XY)),
             )        
         S.aperture_xy.connect_to_hardware(
             read_func=R.get_ap_xy,
-            write_func=lambda XY: R.set_ap_xy(*XY),
+            write_func=self.coalesced_write('aperture_xy', lambda XY: R.set_ap_xy(*XY)),
             )        
         S.beamshift_xy.connect_to_hardware(
-             write_func=lambda XY: R.set_beam_shift(*XY)
+             read_func=self.shadow_read('beamshift_xy'),
+             write_func=self.shadow_write('beamshift_xy', lambda XY: R.set_beam_shift(*XY))
              )        
         S.WD.connect_to_hardware(
                 read_func = R.get_wd,
-                write_func = R.set_wd
+                write_func = self.coalesced_write('WD', self.write_WD)
                 )                
         S.select_aperture.connect_to_hardware(
                 read_func = R.get_ap,
@@ -234,7 +565,7 @@ class SEM_Remcon_HW(HardwareComponent):
                 )        
         S.kV.connect_to_hardware(
             read_func = R.get_kV,
-            write_func = R.set_kV)       
+            write_func = self.write_kV)       
         S.scm_state.connect_to_hardware(
             write_func=R.scm_state
             )
@@ -257,15 +588,465 @@ class SEM_Remcon_HW(HardwareComponent):
 #                 #set detector offset to zero so analog data is quantitative
         #R.set_chan_bright(50,True)
         #R.set_chan_bright(50,False)
+        for name in self.snapshot_read_settings + ('scm_current',):
+            self.timestamp_reads(name)
         self.read_from_hardware()
         
         self.SEM_load_ini() #get stored settings list
             
+    def timestamp_reads(self, name):
+        # wrap the read_func of a connected setting to note when it was last read
+        lq = self.settings.get_lq(name)
+        read_func = lq.hardware_read_func
+        if read_func is None:
+            return
+        def func():
+            val = read_func()
+            self.read_times[name] = time.time()
+            return val
+        lq.hardware_read_func = func
+
+    def snapshot(self, max_age=None):
+        '''
+        imaging relevant state in one pass with the remcon lock held, so no other
+        thread's commands interleave. Values read within max_age s (default
+        snapshot_max_age) are not read again.
+        returns immutable RemconSnapshot, latency field is the time taken (s)
+        '''
+        S = self.settings
+        if max_age is None:
+            max_age = S['snapshot_max_age']
+        t0 = time.perf_counter()
+        self.flush_writes() # pending writes need the lock
+        with self.remcon.lock:
+            now = time.time()
+            for name in self.snapshot_read_settings:
+                lq = S.get_lq(name)
+                if lq.hardware_read_func is not None and now - self.read_times.get(name, 0) > max_age:
+                    lq.read_from_hardware()
+            if S['scm_state'] and now - self.read_times.get('scm_current', 0) > max_age:
+                S.scm_current.read_from_hardware()
+            d = {name: S[name] for name in self.snapshot_read_settings + self.snapshot_cached_settings}
+        d['scm_current'] = S['scm_current'] if S['scm_state'] else None
+        d['probe_current'] = S['probe_current'] if 'probe_current' in S.as_dict() else None
+        d['pixel_size'] = S['full_size'] / 1024 # SEM pixel size is image_width / 1024
+        d['time'] = now
+        d['latency'] = time.perf_counter() - t0
+        S['snapshot_latency'] = d['latency']
+        return RemconSnapshot.from_dict(d)
+
+    def predict_stage_move(self):
+        '''
+        (t_start, predicted duration) of the last commanded stage move,
+        None if no move is pending or its start pose is unknown
+        '''
+        move = self.remcon.last_stage_move
+        if move is None or move[1] is None:
+            return None
+        t_start, start, target = move
+        return t_start, self.stage_model.predict(start, target)
+
+    def finish_stage_move(self, t_done, learn=True):
+        # feed the finished move into the model and check it against the prediction
+        # learn=False when t_done is only an upper bound on when the stage stopped
+        with self.stage_move_lock:
+            move = self.remcon.last_stage_move
+            self.remcon.last_stage_move = None
+        self.remcon.end_stage_move_span()
+        if move is None:
+            return
+        if self.settings['focus_map_enabled']:
+            self.apply_focus_map()
+        if move[1] is None:
+            return
+        t_start, start, target = move
+        predicted = self.stage_model.predict(start, target)
+        duration = t_done - t_start
+        fault = duration > self.settings['stage_fault_factor']*predicted + 1.0
+        self.settings['stage_move_fault'] = fault
+        if fault:
+            self.log.warning("stage move took {:.1f} s, predicted {:.1f} s, possible fault".format(
+                duration, predicted))
+            return # do not learn from faulty moves
+        if learn:
+            self.stage_model.record(start, target, duration)
+
+    def safe_move(self, x=None, y=None, z=None, tilt=None, rot=None, idle_func=None):
+        '''
+        absolute stage move (None keeps an axis) in as few legs as the collision
+        envelope allows, a Z retract is only added when the direct path is unsafe
+        (without an envelope file z is always lowered before the other axes move)
+        waits for each leg, raises IOError if a leg does not finish
+        returns number of legs
+        '''
+        start = list(self.remcon.get_stage_position()[:5])
+        target = [s if t is None else float(t) for s, t in zip(start, (x, y, z, tilt, rot))]
+        legs = self.stage_envelope.plan_move(start, target)
+        if len(legs) > 1:
+            print("safe_move: retracting z to {:.3f} mm".format(legs[-2][2]))
+        for pose in legs:
+            self.remcon.set_stage_position(*pose)
+            if not self.wait_until_stage_stopped(idle_func=idle_func):
+                # never continue to the next leg (eg raising z) from an unknown pose
+                raise IOError("stage move to {} did not complete".format(pose))
+        return len(legs)
+
+    def load_focus_map(self):
+        M = self.focus_map
+        M.fname = self.settings['focus_map_file']
+        M.points = M.points[:0]
+        if os.path.exists(M.fname):
+            M.load()
+            self.settings['focus_map_model'] = M.model
+        M.fit()
+        self.settings['focus_map_points'] = len(M)
+
+    def on_focus_map_model(self):
+        self.focus_map.model = self.settings['focus_map_model']
+        self.focus_map.fit()
+
+    def add_focus_point(self, wd=None):
+        '''
+        record current stage x, y with WD (default current WD) as an in-focus point
+        '''
+        S = self.settings
+        self.flush_writes()
+        if wd is None:
+            wd = S['WD']
+        self.focus_map.add(S['stage_x'], S['stage_y'], wd)
+        S['focus_map_points'] = len(self.focus_map)
+
+    def apply_focus_map(self):
+        '''
+        set WD from the focus map at the current stage position, returns WD or None
+        returns once WD (and with auto_align the alignment) is sent, callers image next
+        '''
+        wd = self.focus_map.predict(self.settings['stage_x'], self.settings['stage_y'])
+        if wd is not None:
+            self.settings['WD'] = wd
+            self.flush_writes()
+        return wd
+
+    @staticmethod
+    def idle_sleep(dt, idle_func=None):
+        if idle_func is None:
+            if dt > 0:
+                time.sleep(dt)
+            return
+        t_end = time.time() + dt
+        while True:
+            idle_func()
+            remaining = t_end - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(0.05, remaining))
+
+    def wait_until_stage_stopped(self, timeout=None, poll_interval=0.02, idle_func=None):
+        '''
+        wait for the last commanded stage move, returns False on timeout
+        sleeps until shortly before the move-time model predicts completion, then polls,
+        with one early poll so moves faster than predicted are noticed
+        only stops seen between a moving and a stopped poll (or at the early poll,
+        well before the prediction) are fed to the move-time model
+        timeout defaults to stage_fault_factor times the prediction (30 s if unknown)
+        idle_func is called while waiting, eg Qt processEvents
+        '''
+        with tracer.span('stage_wait', 'stage'):
+            pred = self.predict_stage_move()
+            if pred is None:
+                t0, t_wake = time.time(), time.time() + 0.05 # motion flag may lag behind the c95 command
+                t_early = None
+                if timeout is None:
+                    timeout = 30.0
+            else:
+                t0, duration = pred
+                self.settings['stage_move_eta'] = duration
+                t_wake = t0 + max(0.05, duration - max(0.2, 0.1*duration))
+                t_early = t0 + 0.4*duration if duration > 0.5 else None
+                if timeout is None:
+                    timeout = self.settings['stage_fault_factor']*duration + 5.0
+            seen_moving = False
+            if t_early is not None:
+                self.idle_sleep(t_early - time.time(), idle_func)
+                self.settings.stage_position.read_from_hardware()
+                if not self.settings['stage_is_moving']:
+                    # much faster than predicted, the upper bound still pulls the model down
+                    self.finish_stage_move(time.time())
+                    return True
+                seen_moving = True
+            self.idle_sleep(t_wake - time.time(), idle_func)
+            while True:
+                self.settings.stage_position.read_from_hardware()
+                if not self.settings['stage_is_moving']:
+                    self.finish_stage_move(time.time(), learn=seen_moving)
+                    return True
+                seen_moving = True
+                if time.time() - t0 > timeout:
+                    print("sem stage timeout occurred")
+                    self.settings['stage_move_fault'] = True
+                    return False
+                self.idle_sleep(poll_interval, idle_func)
+
+    def move_field(self, dx, dy, wait=True):
+        '''
+        move field of view by dx, dy (m, image axes)
+        uses beam shift alone when the result stays within beamshift_limit,
+        otherwise moves the stage by the full offset and re-centers beam shift
+        returns 'beamshift' or 'stage'
+        '''
+        C = self.beamshift_calib
+        wd = self.settings['WD']
+        shift = np.asarray(self.settings['beamshift_xy'], dtype=float)
+        new_shift = shift + C.offset_to_shift([dx, dy], wd)
+        if np.all(np.abs(new_shift) <= self.settings['beamshift_limit']):
+            self.settings['beamshift_xy'] = new_shift
+            return 'beamshift'
+        # offset of the unshifted beam position, handed to the stage
+        total = C.shift_to_offset(shift, wd) + np.array([dx, dy])
+        stage_mm = C.offset_to_stage(total)
+        self.settings['beamshift_xy'] = [0.0, 0.0]
+        self.remcon.set_stage_delta(x=stage_mm[0], y=stage_mm[1])
+        if wait:
+            self.wait_until_stage_stopped()
+        return 'stage'
+    
+    def calibrate_beam_shift(self, acquire_func, shift_step=20.0, stage_step=None):
+        '''
+        measure field offset per beam shift % (and per stage mm if stage_step is given)
+        by cross-correlating frames from acquire_func, saves to beamshift_calib_file
+        '''
+        C = self.beamshift_calib
+        pixel_size = self.settings['full_size'] / np.shape(acquire_func())[1]
+        old_shift = list(self.settings['beamshift_xy'])
+        def set_shift(x, y):
+            self.settings['beamshift_xy'] = [x, y]
+        C.calibrate_shift(set_shift, acquire_func, pixel_size, self.settings['WD'], step=shift_step)
+        if stage_step is not None:
+            def move_stage(dx, dy):
+                self.remcon.set_stage_delta(x=dx, y=dy)
+                self.wait_until_stage_stopped()
+            C.calibrate_stage(move_stage, acquire_func, pixel_size, step=stage_step)
+        self.settings['beamshift_xy'] = old_shift
+        C.save(self.settings['beamshift_calib_file'])
+        return C
+
+    def write_kV(self, val):
+        # remember where the ramp starts so wait_for_kV can predict its end
+        from_kV = self.remcon.get_kV()
+        self.remcon.set_kV(val)
+        if self.settings['eht_on']:
+            self.kV_ramp = (time.time(), from_kV, min(val, 30.0))
+        else:
+            # no ramp while EHT is off, the value applies when it is switched on
+            self.kV_ramp = None
+        if self.settings['auto_align']:
+            self.apply_alignment(kV=val)
+            
+    def write_WD(self, val):
+        self.remcon.set_wd(val)
+        if self.settings['auto_align']:
+            self.apply_alignment(WD=val)
+
+    def apply_alignment(self, kV=None, WD=None):
+        '''
+        set stig, aperture and gun alignment interpolated from the alignment table
+        for kV, WD (default current values) and the selected aperture
+        returns the suggestion dict, None if the table has nothing for this aperture
+        '''
+        S = self.settings
+        if kV is None:
+            kV = S['kV']
+        if WD is None:
+            WD = S['WD']
+        v = self.align_calib.suggest(kV, WD, S['select_aperture'])
+        if v is None:
+            return None
+        S['stig_xy'] = [v['stig_x'], v['stig_y']]
+        S['aperture_xy'] = [v['aperture_x'], v['aperture_y']]
+        S['gun_xy'] = [v['gun_x'], v['gun_y']]
+        return v
+
+    def record_alignment(self):
+        'add current (aligned) stig, aperture and gun values to the alignment table'
+        S = self.settings
+        self.flush_writes()
+        values = {name: S[name] for name in AlignmentCalibration.value_columns}
+        self.align_calib.add(S['kV'], S['WD'], S['select_aperture'], values)
+
+    def wait_for_kV(self, timeout=60.0):
+        '''
+        block until EHT reaches the last written kV, returns settle time (s)
+        uses learned ramp rate to sleep through most of the ramp
+        returns 0 at once if no ramp is pending
+        '''
+        return self.kV_settled_future(timeout=timeout).result()
+
+    def kV_settled_future(self, timeout=60.0):
+        'non-blocking wait_for_kV, returns concurrent.futures.Future'
+        with self.kV_ramp_lock:
+            ramp = self.kV_ramp
+            if ramp is None:
+                future = Future()
+                future.set_result(0.0)
+                return future
+            if self.kV_ramp_future is not None and self.kV_ramp_future[0] is ramp:
+                return self.kV_ramp_future[1]
+            t_start, from_kV, target = ramp
+            future = self.eht_tracker.kV_future(self.remcon, target, from_kV, t_start=t_start,
+                                                tol=self.settings['eht_settle_tol'], timeout=timeout)
+            self.kV_ramp_future = (ramp, future)
+        future.add_done_callback(lambda f, ramp=ramp: self.on_kV_ramp_done(ramp, f))
+        return future
+
+    def on_kV_ramp_done(self, ramp, future):
+        # a settled ramp is recorded once, later waits return 0 until the next kV write
+        with self.kV_ramp_lock:
+            if future.exception() is None and self.kV_ramp is ramp:
+                self.kV_ramp = None
+            if self.kV_ramp_future is not None and self.kV_ramp_future[0] is ramp:
+                self.kV_ramp_future = None
+
+    def start_drift_correction(self, acquire_func, interval=30.0, **kwargs):
+        '''
+        start closed loop drift compensation with beam shift, see DriftCorrector
+        acquire_func(): returns a reference frame of the same field each call
+        '''
+        if not self.beamshift_calib.calibrated:
+            raise ValueError("drift correction needs a beam shift calibration, run calibrate_beam_shift")
+        self.stop_drift_correction()
+        self.drift_corrector = DriftCorrector(self, acquire_func, interval=interval, **kwargs)
+        self.drift_corrector.start()
+        return self.drift_corrector
+    
+    def stop_drift_correction(self, log_fname=None):
+        D = self.drift_corrector
+        if D is None:
+            return
+        D.stop()
+        if log_fname:
+            D.save_log(log_fname)
+        self.drift_corrector = None
+        return D
+
+    def auto_contrast(self, acquire_func, channels=(0, 1), **kwargs):
+        '''
+        converge detector contrast/brightness on target black/white levels,
+        see AutoContrast for arguments, returns its result dict
+        '''
+        self.flush_writes()
+        result = AutoContrast(self.remcon, acquire_func, **kwargs).run(channels)
+        for ch in channels:
+            # values were just written, no need to read them back
+            self.settings.get_lq('contrast{}'.format(ch)).update_value(
+                result[ch]['contrast'], update_hardware=False)
+        return result
+
+    def focus_sweep(self, acquire_func, wd_values, stig_x_values=None, stig_y_values=None,
+                    score_func='gradient', settle_time=0.2, **kwargs):
+        '''
+        run a FocusSweep on this instrument, leaves the best conditions applied
+        see FocusSweep.run for arguments and returned dict
+        '''
+        sweep = FocusSweep(self.remcon, acquire_func, score_func=score_func, settle_time=settle_time)
+        self.flush_writes()
+        result = sweep.run(wd_values, stig_x_values, stig_y_values, **kwargs)
+        self.settings.WD.read_from_hardware()
+        self.settings.stig_xy.read_from_hardware()
+        if self.settings['focus_map_enabled']:
+            self.add_focus_point(result['wd'])
+        return result
+
+    def spot_scan(self, points, dwell, acquire_func=None, order='nearest'):
+        '''
+        batched spot mode acquisition, see SpotScanEngine.run
+        '''
+        self.flush_writes()
+        engine = SpotScanEngine(self.remcon, acquire_func)
+        return engine.run(points, dwell, order=order)
+
+    def probe_mode(self):
+        'probe current mode the beam current depends on, besides kV and aperture'
+        return 'high_current' if self.settings['high_current'] else 'normal'
+
+    def update_probe_estimate(self):
+        S = self.settings
+        est = self.probe_cal.estimate(self.probe_mode(), S['kV'], S['select_aperture'])
+        # 0 until this mode, kV and aperture has been calibrated
+        S['probe_current_estimate'] = 0.0 if est is None else est
+
+    def on_probe_mode_written(self, val=None):
+        self.update_probe_estimate()
+        if not self.settings['probe_cal_enabled']:
+            return
+        # macros return before the beam has changed, measure in the background
+        self.probe_cal_pending = True
+        if self.probe_cal_thread is None or not self.probe_cal_thread.is_alive():
+            self.probe_cal_thread = threading.Thread(target=self.probe_cal_loop, daemon=True,
+                                                     name='probe_cal')
+            self.probe_cal_thread.start()
+
+    def probe_cal_loop(self):
+        # one calibration after the last of several quick mode changes
+        while self.probe_cal_pending:
+            self.probe_cal_pending = False
+            try:
+                self.calibrate_probe_current()
+            except IOError as err:
+                self.log.warning("probe current calibration failed: {}".format(err))
+
+    def calibrate_probe_current(self, force=False):
+        '''
+        beam current for the current probe mode, kV and aperture, from the
+        calibration cache, re-measured with the SCM if stale or drifted
+        (or force), returns current (A) or None if the beam is blanked
+        '''
+        S = self.settings
+        if S['beam_blanking']:
+            self.log.info("probe current calibration skipped, beam blanked")
+            return None
+        self.wait_for_kV()
+        cal = self.probe_cal
+        cal.max_age = 0.0 if force else S['probe_cal_max_age']*3600.
+        cal.drift_tol = S['probe_cal_tol']
+        mode, kV, aperture = self.probe_mode(), S['kV'], S['select_aperture']
+        def measure(fraction):
+            # through the setting so scm_state stays in sync with the hardware
+            return measure_scm(self.remcon, window=fraction*S['probe_cal_window'],
+                               scm_on=S['scm_state'],
+                               set_scm_state=lambda on: S.scm_state.update_value(on))
+        current, action = cal.update(mode, kV, aperture, measure)
+        S['probe_current_estimate'] = current
+        self.log.info("probe current {} {} kV aperture {}: {:.3g} A ({})".format(
+            mode, kV, aperture, current, action))
+        return current
+
+    def on_trace_enabled(self):
+        tracer.enabled = self.settings['trace_enabled']
+
+    def export_trace(self, fname=None):
+        '''
+        write recorded spans as Chrome trace json, open in chrome://tracing
+        or ui.perfetto.dev
+        '''
+        if fname is None:
+            fname = self.settings['trace_file']
+        tracer.export_chrome(fname)
+        self.log.info("remcon trace: {} events written to {}".format(len(tracer.events), fname))
+        return fname
+
     def disconnect(self):
+        self.stop_drift_correction()
+        self.reconnect_stop.set()
+        self.flush_writes(timeout=5.0)
+        self.shadow.flush()
         self.settings.disconnect_all_from_hardware()
         if hasattr(self, 'remcon'):
+            self.remcon.link_lost_callback = None
             self.remcon.close()
             del self.remcon
+        self.settings['link_state'] = 'disconnected'
+        if self.telemetry is not None:
+            self.telemetry.flush()
             
     def SEM_load_ini(self, fname='SEM_saved_settings.ini'):
         self.log.info("ini settings loading from " + fname)
@@ -279,11 +1060,37 @@ class SEM_Remcon_HW(HardwareComponent):
         
     def threaded_update(self):
         
-        self.settings.magnification.read_from_hardware()
-        self.settings.stage_position.read_from_hardware()
-        if self.settings['stage_is_moving']:
-            time.sleep(0.05)
+        if not self.remcon.online:
+            # reconnect_loop is working on it
+            time.sleep(0.5)
+            return
+        try:
+            with tracer.span('threaded_update', 'poll'):
+                if not self.coalesced_write_pending('magnification'):
+                    # reading while a write is queued would jump the spin box back
+                    self.settings.magnification.read_from_hardware()
+                self.settings.stage_position.read_from_hardware()
+                if (self.telemetry is not None
+                        and time.time() - self.telemetry_last_poll > self.settings['telemetry_period']):
+                    self.telemetry_poll()
+        except IOError:
+            if self.remcon.online:
+                raise
+            return
+        pred = self.predict_stage_move()
+        was_moving = self.stage_was_moving
+        self.stage_was_moving = moving = self.settings['stage_is_moving']
+        if moving:
+            if pred is None:
+                time.sleep(0.05)
+            else:
+                # nothing to see until the predicted end of the move
+                t_start, duration = pred
+                time.sleep(min(1.0, max(0.05, t_start + duration - time.time() - 0.1)))
         else:
+            if pred is not None and was_moving:
+                # nobody waited on this move, still learn from it
+                self.finish_stage_move(time.time())
             time.sleep(1.0)
 
 #         if 'app' in config.sections():
@@ -300,12 +1107,14 @@ class SEM_Remcon_HW(HardwareComponent):
 class Auger_Remcon_HW(SEM_Remcon_HW):
     '''subclass SEM_Remcon_HW to handle Auger-specific command set'''
     
+    write_only_settings = ('gun_xy', 'beamshift_xy', 'dual_channel', 'probe_current')
         
     def setup(self):
         SEM_Remcon_HW.setup(self)
         self.settings.New('probe_current', dtype=str, 
                           initial='Max',
                           choices=('Max','3.0 nA','1.0 nA','400 pA'))
+        self.settings.probe_current.add_listener(self.update_probe_estimate)
         
         self.settings['SEM_mode'] = 'Auger'
        
@@ -320,7 +1129,9 @@ class Auger_Remcon_HW(SEM_Remcon_HW):
         S.high_current.change_readonly(True)
                 
         self.settings.probe_current.connect_to_hardware(
-                write_func = self.remcon.set_probe_current
+                read_func = self.shadow_read('probe_current'),
+                write_func = self.shadow_write('probe_current', self.remcon.set_probe_current,
+                                               after_write=self.on_probe_mode_written)
                 )
         
         for lq in self.settings.as_list(): 
@@ -330,6 +1141,9 @@ class Auger_Remcon_HW(SEM_Remcon_HW):
 
 
     
+    def probe_mode(self):
+        return self.settings['probe_current']
+
     def disconnect(self):
         SEM_Remcon_HW.disconnect(self)
 
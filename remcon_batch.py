@@ -0,0 +1,275 @@
+'''
+Command batching for Remcon32
+
+Inside a batch, Remcon32.cmd_response queues set commands into a program
+instead of sending them. The program is optimized and sent when a read
+needs it, when the batch ends, or window seconds after the first queued
+command:
+
+    with remcon.batch() as b:
+        remcon.set_chan_levels(40, 50, primary=False)
+        remcon.set_chan_levels(45, 50, primary=False)
+        remcon.set_wd(9.2)
+    print(b.stats)
+
+Peephole passes over the queued set commands:
+    superseded_writes  earlier write to the same parameter (and display zone)
+    zone_switches      mac 2 / mac 3 overridden by the next zone switch, or
+                       switching to the zone already selected
+and for reads:
+    reads_reused       repeated identical read with no write it depends on
+    reads_hoisted      read answered before queued writes it does not depend on
+                       (reordered, nothing removed)
+
+Stage moves, spot dwells, autoscale (norm), other macros and unknown commands
+are never dropped, macros and unknown commands are barriers no pass reorders
+across. No write before a stage move is dropped for one after it (eg scm 0
+re-enabling the touch alarm before c95).
+Set commands return None at once, a remcon error in one is raised when the
+program is sent. Commands from other threads flush the batch and are sent
+directly, updating the batch's read cache and known zone.
+'''
+import threading
+
+# set command -> parameter it writes
+write_keys = {'EHT': 'eht', 'bmon': 'eht_state', 'bblk': 'blank', 'stim': 'stig',
+              'aper': 'aper', 'aaln': 'aln', 'galn': 'gal', 'BEAM': 'beam', 'scm': 'scm',
+              'bgtt': 'bgt', 'crst': 'cst', 'det': 'det', 'edx': 'edx', 'mag': 'mag',
+              'focs': 'foc', 'spot': 'spot', 'c95': 'stage', 'norm': 'norm'}
+# read command -> parameters its answer depends on
+read_deps = {'EHT?': ('eht', 'eht_state'), 'bbl?': ('blank',), 'sti?': ('stig',),
+             'apr?': ('aper',), 'aln?': ('aln', 'aper'), 'gal?': ('gal',),
+             'prb?': ('scm', 'eht', 'eht_state', 'aper', 'beam', 'stage'),
+             'bgt?': ('bgt', 'det'), 'cst?': ('cst', 'det'), 'det?': ('det',),
+             'exs?': ('edx',), 'mag?': ('mag',), 'foc?': ('foc',), 'pix?': ('mag',),
+             'c95?': ('stage',), 'ist?': ()}
+# per display, selected with mac 2 (zone 0) / mac 3 (zone 1)
+zone_keys = ('bgt', 'cst', 'det', 'norm')
+zone_macros = {'mac 2': 0, 'mac 3': 1}
+# parameters that apply to whatever a selection write selects, eg aaln to the current aperture
+selected_by = {'aper': ('aln',)}
+# actions rather than states, a later one does not make an earlier one redundant
+keep_keys = ('stage', 'norm', 'spot')
+# state during these actions matters, writes before one are never superseded by writes after it
+fence_keys = ('stage',)
+# change while nobody writes, never answered from cache
+volatile_reads = ('EHT?', 'c95?')
+
+
+class _Op(object):
+    __slots__ = ('cmd', 'error_ok', 'key', 'zone_to', 'barrier')
+
+    def __init__(self, cmd, error_ok):
+        self.cmd = cmd
+        self.error_ok = error_ok
+        self.zone_to = zone_macros.get(cmd.strip())
+        verb = cmd.split(' ', 1)[0]
+        self.key = write_keys.get(verb)
+        self.barrier = self.zone_to is None and self.key is None
+
+
+def _zone_tags(ops, zone):
+    # zone each op runs in, a segment number where the zone is not known
+    tags = []
+    seg = 0
+    for op in ops:
+        if op.zone_to is not None:
+            zone = op.zone_to
+            seg += 1
+        tags.append(zone if zone is not None else ('seg', seg))
+    return tags
+
+
+def drop_superseded(ops, zone):
+    tags = _zone_tags(ops, zone)
+    later = set()
+    out = []
+    for op, tag in zip(reversed(ops), reversed(tags)):
+        if op.barrier or op.key in fence_keys:
+            later = set()
+        elif op.key is not None:
+            k = (op.key, tag) if op.key in zone_keys else op.key
+            if k in later and op.key not in keep_keys:
+                continue
+            later.add(k)
+            # a write before this selection went to the previously selected item
+            later.difference_update(selected_by.get(op.key, ()))
+            # and the selection before this write is needed for it to reach its item
+            later.difference_update(sel for sel, keys in selected_by.items() if op.key in keys)
+        out.append(op)
+    out.reverse()
+    return out
+
+
+def merge_zone_switches(ops, zone):
+    out = []
+    for i, op in enumerate(ops):
+        if op.zone_to is not None:
+            if op.zone_to == zone:
+                continue
+            overridden = False
+            for nxt in ops[i+1:]:
+                if nxt.barrier or nxt.key in zone_keys:
+                    break
+                if nxt.zone_to is not None:
+                    overridden = True
+                    break
+            if overridden:
+                continue
+            zone = op.zone_to
+        elif op.barrier:
+            zone = None # a macro may change zone
+        out.append(op)
+    return out
+
+
+def optimize(ops, zone=None, stats=None):
+    '''
+    peephole passes until nothing changes, zone: selected display zone before
+    ops or None if unknown; returns optimized ops, adds removal counts to stats
+    '''
+    if stats is None:
+        stats = dict(superseded_writes=0, zone_switches=0)
+    while True:
+        n0 = len(ops)
+        ops2 = drop_superseded(ops, zone)
+        stats['superseded_writes'] += len(ops) - len(ops2)
+        ops3 = merge_zone_switches(ops2, zone)
+        stats['zone_switches'] += len(ops2) - len(ops3)
+        ops = ops3
+        if len(ops) == n0:
+            return ops
+
+
+class RemconBatch(object):
+
+    def __init__(self, remcon, window=None):
+        '''
+        window: s, send queued commands this long after the first one even
+        if nothing reads, None to wait for a read or the end of the batch
+        '''
+        self.remcon = remcon
+        self.window = window
+        self.owner = None
+        self.lock = threading.RLock()
+        self.pending = []
+        self.cache = dict()
+        self.zone = None
+        self.timer = None
+        self.stats = dict(commands_in=0, commands_sent=0, superseded_writes=0,
+                          zone_switches=0, reads_reused=0, reads_hoisted=0)
+
+    def __enter__(self):
+        self.owner = threading.get_ident()
+        self.remcon.batch_program = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.remcon.batch_program = None
+        if exc_type is None:
+            self.flush()
+        else:
+            # state after an exception is unknown, do not send half a sequence
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                self.pending = []
+        return False
+
+    def submit(self, cmd, error_ok=False):
+        if threading.get_ident() != self.owner:
+            with self.lock:
+                self.flush()
+                val = self.remcon.send_cmd(cmd, error_ok)
+                if not cmd.strip().endswith('?'):
+                    # eg coalesced writer threads, cached reads and known zone may be stale now
+                    op = _Op(cmd, error_ok)
+                    self._invalidate(op)
+                    if op.zone_to is not None:
+                        self.zone = op.zone_to
+                    elif op.barrier:
+                        self.zone = None
+            return val
+        with self.lock:
+            self.stats['commands_in'] += 1
+            cmd_s = cmd.strip()
+            if cmd_s.endswith('?'):
+                return self._read(cmd_s, error_ok)
+            op = _Op(cmd, error_ok)
+            self.pending.append(op)
+            self._invalidate(op)
+            if self.window is not None and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            return None
+
+    def _invalidate(self, op):
+        if op.barrier:
+            self.cache.clear()
+            return
+        for (cmd, zone) in list(self.cache):
+            deps = read_deps.get(cmd)
+            if deps is None or op.key in deps:
+                del self.cache[(cmd, zone)]
+
+    def _read(self, cmd, error_ok):
+        deps = read_deps.get(cmd)
+        zone_dep = deps is not None and any(k in zone_keys for k in deps)
+        # zone this read runs in, from the queued program
+        zone = self.zone
+        last_dep = -1
+        for i, op in enumerate(self.pending):
+            if op.zone_to is not None:
+                zone = op.zone_to
+            elif op.barrier:
+                zone = None
+            if (deps is None or op.barrier or op.key in deps
+                    or (zone_dep and op.zone_to is not None)):
+                last_dep = i
+        cache_key = (cmd, zone if zone_dep else None)
+        if cmd not in volatile_reads and cache_key in self.cache:
+            self.stats['reads_reused'] += 1
+            return self.cache[cache_key]
+        if last_dep + 1 < len(self.pending):
+            self.stats['reads_hoisted'] += 1
+        self._send(last_dep + 1)
+        val = self.remcon.send_cmd(cmd, error_ok)
+        if deps is not None:
+            self.cache[cache_key] = val
+        return val
+
+    def _send(self, n):
+        'optimize and send the first n queued commands'
+        if n <= 0:
+            return
+        ops, self.pending = self.pending[:n], self.pending[n:]
+        zone0 = self.zone
+        ops = optimize(ops, zone0, self.stats)
+        try:
+            for op in ops:
+                self.remcon.send_cmd(op.cmd, op.error_ok)
+                self.stats['commands_sent'] += 1
+                if op.zone_to is not None:
+                    self.zone = op.zone_to
+                elif op.barrier:
+                    self.zone = None
+        except IOError:
+            self.pending = []
+            self.cache.clear()
+            self.zone = None
+            raise
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._send(len(self.pending))
+
+    def report(self):
+        s = self.stats
+        return ("remcon batch: {commands_in} commands in, {commands_sent} set commands sent, removed "
+                "{superseded_writes} superseded writes, {zone_switches} zone switches, "
+                "{reads_reused} repeated reads; {reads_hoisted} reads hoisted".format(**s))
@@ -0,0 +1,147 @@
+'''
+Headless scripting of Remcon32, no ScopeFoundry or Qt
+
+    python -m <this package> --port COM4 "get_kV" "set_wd 9.2" "raw mag?"
+    python -m <this package> --port COM4 --batch commands.json
+    python -m <this package> --port COM4 --batch commands.yaml   (needs pyyaml)
+    python -m <this package> --port COM4 --batch -               (json on stdin)
+
+A batch is a list of commands, each either a string "method arg1 arg2 ..."
+or a dict {"method": "set_stig", "args": [1.0, -2.0]}. Methods are the
+public Remcon32 methods, "raw" sends its argument as a Remcon32 command
+string. All commands run through one connection, one json result per line
+is printed: {"i", "cmd", "ok", "result" or "error", "dt"}.
+'''
+import argparse
+import contextlib
+import json
+import sys
+import time
+
+from .remcon32 import Remcon32
+from .remcon_shadow_state import to_plain
+
+# not for scripts, would break the shared connection
+blocked_methods = ('open', 'close', 'reopen')
+
+
+def parse_command(cmd):
+    'returns (method, args) from a batch entry'
+    if isinstance(cmd, dict):
+        if 'raw' in cmd:
+            return 'raw', [cmd['raw']]
+        return cmd['method'], list(cmd.get('args', []))
+    method, _, rest = cmd.strip().partition(' ')
+    if method == 'raw':
+        return 'raw', [rest]
+    args = []
+    for token in rest.split():
+        try:
+            args.append(json.loads(token))
+        except ValueError:
+            args.append(token)
+    return method, args
+
+
+class RemconScript(object):
+
+    def __init__(self, remcon):
+        self.remcon = remcon
+
+    def call(self, method, args):
+        R = self.remcon
+        if method == 'raw':
+            return R.cmd_response(*args)
+        if method.startswith('_') or method in blocked_methods or not hasattr(R, method):
+            raise ValueError("unknown command {}".format(method))
+        func = getattr(R, method)
+        if not callable(func):
+            raise ValueError("unknown command {}".format(method))
+        return func(*args)
+
+    def run_iter(self, batch, stop_on_error=False):
+        'yields one result dict per command'
+        for i, cmd in enumerate(batch):
+            t0 = time.perf_counter()
+            result = dict(i=i, cmd=cmd)
+            try:
+                method, args = parse_command(cmd)
+                result['result'] = to_plain(self.call(method, args))
+                result['ok'] = True
+            except (IOError, ValueError, TypeError, KeyError) as err:
+                result['ok'] = False
+                result['error'] = str(err)
+            result['dt'] = time.perf_counter() - t0
+            yield result
+            if stop_on_error and not result['ok']:
+                return
+
+    def run(self, batch, stop_on_error=False):
+        return list(self.run_iter(batch, stop_on_error))
+
+
+def run_batch(port, batch, stop_on_error=False):
+    'open port, run batch, close, returns list of result dicts'
+    R = Remcon32(port=port)
+    try:
+        return RemconScript(R).run(batch, stop_on_error)
+    finally:
+        R.close()
+
+
+def load_batch(fname, fmt=None):
+    if fname == '-':
+        text = sys.stdin.read()
+    else:
+        with open(fname, 'r') as f:
+            text = f.read()
+    if fmt is None:
+        fmt = 'yaml' if fname.endswith(('.yml', '.yaml')) else 'json'
+    if fmt == 'yaml':
+        import yaml # optional, only for yaml batches
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Remcon32 commands without ScopeFoundry')
+    parser.add_argument('commands', nargs='*', help='commands, eg "get_kV" "set_wd 9.2" "raw mag?"')
+    parser.add_argument('--port', default='COM4')
+    parser.add_argument('--batch', help='json or yaml file with a list of commands, - for stdin')
+    parser.add_argument('--format', choices=('json', 'yaml'), help='batch file format, default by extension')
+    parser.add_argument('--stop-on-error', action='store_true')
+    parser.add_argument('--optimize', action='store_true',
+                        help='queue and optimize set commands (see remcon_batch), '
+                             'set command errors are then reported at the end')
+    args = parser.parse_args(argv)
+
+    batch = list(args.commands)
+    if args.batch:
+        batch.extend(load_batch(args.batch, args.format))
+
+    R = Remcon32(port=args.port)
+    n_failed = 0
+    program = None
+    # stdout carries only json results, Remcon32 debug prints go to stderr
+    out = sys.stdout
+    try:
+        try:
+            with contextlib.ExitStack() as stack:
+                stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+                if args.optimize:
+                    program = stack.enter_context(R.batch())
+                for result in RemconScript(R).run_iter(batch, args.stop_on_error):
+                    n_failed += not result['ok']
+                    print(json.dumps(result), file=out)
+                    out.flush()
+        except IOError as err:
+            # run_iter reports per command errors, this is the optimized batch failing when sent
+            if program is None:
+                raise
+            n_failed += 1
+            print(json.dumps(dict(cmd='batch', ok=False, error=str(err))), file=out)
+        if program is not None:
+            print(json.dumps(dict(cmd='batch_report', stats=program.stats)), file=sys.stderr)
+    finally:
+        R.close()
+    return 1 if n_failed else 0
@@ -0,0 +1,80 @@
+'''
+Last-write-wins coalescing of setting writes
+
+While a write is in flight only the newest submitted value is kept, values
+superseded before they were sent are dropped. Keeps the 9600 baud link from
+backing up when a spin box or slider is dragged.
+'''
+import threading
+import time
+
+_nothing = object()
+
+
+class CoalescedWriter(object):
+
+    def __init__(self, write_func, min_interval=0.0, name='', after_write=None):
+        '''
+        write_func: called with the value, from a worker thread
+        min_interval: optional rate limit, s between start of consecutive writes
+        after_write: optional callable(val) run after each successful write
+        '''
+        self.write_func = write_func
+        self.min_interval = min_interval
+        self.name = name
+        self.after_write = after_write
+
+        self.cond = threading.Condition()
+        self.pending = _nothing
+        self.busy = False
+        self.last_write_time = 0.0
+
+        self.n_submitted = 0
+        self.n_written = 0
+        self.n_dropped = 0
+        self.last_error = None
+
+    def submit(self, val):
+        'returns immediately, val is written from the worker thread'
+        with self.cond:
+            self.n_submitted += 1
+            if self.pending is not _nothing:
+                self.n_dropped += 1
+            self.pending = val
+            if not self.busy:
+                self.busy = True
+                threading.Thread(target=self._run, daemon=True,
+                                 name='coalesce_' + self.name).start()
+
+    def _run(self):
+        while True:
+            # rate limit before taking the value, so the newest one is used
+            wait = self.min_interval - (time.perf_counter() - self.last_write_time)
+            if wait > 0:
+                time.sleep(wait)
+            with self.cond:
+                if self.pending is _nothing:
+                    self.busy = False
+                    self.cond.notify_all()
+                    return
+                val = self.pending
+                self.pending = _nothing
+            self.last_write_time = time.perf_counter()
+            try:
+                self.write_func(val)
+            except Exception as err:
+                self.last_error = err
+                print("CoalescedWriter {} write failed: {}".format(self.name, err))
+                continue
+            self.n_written += 1
+            if self.after_write is not None:
+                self.after_write(val)
+
+    def flush(self, timeout=None):
+        'block until all submitted values are written, returns False on timeout'
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.busy, timeout)
+
+    def metrics(self):
+        return dict(submitted=self.n_submitted, written=self.n_written,
+                    dropped=self.n_dropped, busy=self.busy)
@@ -0,0 +1,193 @@
+'''
+Several Remcon32 connections on one bounded I/O worker pool
+
+Each instrument has its own command queue, at most one pool worker drains
+it at a time, so a slow or dead instrument never holds more than one worker
+and commands to one instrument stay in order. Periodic polls are scheduled
+by a single thread. Thread count is max_workers + 1 however many
+instruments are added.
+'''
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import heapq
+import threading
+import time
+
+from .remcon32 import Remcon32
+
+
+class _Instrument(object):
+
+    def __init__(self, name, remcon):
+        self.name = name
+        self.remcon = remcon
+        self.queue = deque()
+        self.active = False
+        self.n_commands = 0
+        self.n_errors = 0
+        self.busy_time = 0.0
+        self.last_latency = None
+        self.last_error = None
+
+    def metrics(self):
+        return dict(n_commands=self.n_commands, n_errors=self.n_errors,
+                    busy_time=self.busy_time, last_latency=self.last_latency,
+                    last_error=self.last_error, queued=len(self.queue),
+                    online=self.remcon.online)
+
+
+class RemconManager(object):
+
+    def __init__(self, max_workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='remcon_io')
+        self.instruments = OrderedDict()
+        self.lock = threading.Lock()
+        # periodic polls: heap of (t_next, seq, name, method, period, callback)
+        self.polls = []
+        self.poll_seq = 0
+        self.poll_cond = threading.Condition(self.lock)
+        self.poll_thread = None
+        self.closed = False
+
+    def add(self, name, port=None, remcon=None):
+        'add an instrument by serial port, or an already open Remcon32'
+        if remcon is None:
+            remcon = Remcon32(port=port)
+        with self.lock:
+            if name in self.instruments:
+                raise ValueError("instrument {} already added".format(name))
+            self.instruments[name] = _Instrument(name, remcon)
+        return remcon
+
+    def remove(self, name):
+        with self.lock:
+            inst = self.instruments.pop(name)
+            self.polls = [p for p in self.polls if p[2] != name]
+            heapq.heapify(self.polls)
+        inst.remcon.close()
+
+    def names(self):
+        return list(self.instruments.keys())
+
+    def submit(self, name, method, *args, **kwargs):
+        '''
+        queue Remcon32 method call on instrument name, returns Future
+        method is a Remcon32 method name or a callable taking the Remcon32
+        '''
+        future = Future()
+        with self.lock:
+            inst = self.instruments[name]
+            inst.queue.append((method, args, kwargs, future))
+            if inst.active:
+                return future
+            inst.active = True
+        self.pool.submit(self._drain, inst)
+        return future
+
+    def _drain(self, inst):
+        while True:
+            with self.lock:
+                if not inst.queue:
+                    inst.active = False
+                    return
+                method, args, kwargs, future = inst.queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            t0 = time.perf_counter()
+            try:
+                if callable(method):
+                    result = method(inst.remcon, *args, **kwargs)
+                else:
+                    result = getattr(inst.remcon, method)(*args, **kwargs)
+            except Exception as err:
+                inst.n_errors += 1
+                inst.last_error = str(err)
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+            dt = time.perf_counter() - t0
+            inst.n_commands += 1
+            inst.busy_time += dt
+            inst.last_latency = dt
+
+    def call(self, name, method, *args, **kwargs):
+        'blocking submit'
+        return self.submit(name, method, *args, **kwargs).result()
+
+    def broadcast(self, method, *args, names=None, timeout=None, **kwargs):
+        '''
+        run method on all (or named) instruments at once
+        returns OrderedDict name -> result, or the exception raised for that instrument
+        '''
+        if names is None:
+            names = self.names()
+        futures = OrderedDict((name, self.submit(name, method, *args, **kwargs)) for name in names)
+        wait(list(futures.values()), timeout=timeout)
+        out = OrderedDict()
+        for name, f in futures.items():
+            if not f.done():
+                out[name] = TimeoutError("no reply within {} s".format(timeout))
+            elif f.exception() is not None:
+                out[name] = f.exception()
+            else:
+                out[name] = f.result()
+        return out
+
+    def blank_all(self, state=True, timeout=5.0):
+        return self.broadcast('set_blank_state', state, timeout=timeout)
+
+    def stage_positions(self, timeout=5.0):
+        return self.broadcast('get_stage_position_dict', timeout=timeout)
+
+    def add_poll(self, name, method, period, callback):
+        '''
+        call method on instrument name every period s, callback(name, result_or_exception)
+        runs on the worker pool
+        '''
+        with self.lock:
+            heapq.heappush(self.polls, (time.time(), self.poll_seq, name, method, period, callback))
+            self.poll_seq += 1
+            self.poll_cond.notify()
+            if self.poll_thread is None:
+                self.poll_thread = threading.Thread(target=self._poll_loop, daemon=True,
+                                                    name='remcon_poll')
+                self.poll_thread.start()
+
+    def _poll_loop(self):
+        with self.lock:
+            while not self.closed:
+                if not self.polls:
+                    self.poll_cond.wait()
+                    continue
+                t_next = self.polls[0][0]
+                now = time.time()
+                if t_next > now:
+                    self.poll_cond.wait(t_next - now)
+                    continue
+                t_next, seq, name, method, period, callback = heapq.heappop(self.polls)
+                inst = self.instruments.get(name)
+                if inst is None:
+                    continue
+                # skip a poll rather than pile them up behind a slow instrument
+                if len(inst.queue) < 2:
+                    self.lock.release()
+                    try:
+                        f = self.submit(name, method)
+                    finally:
+                        self.lock.acquire()
+                    f.add_done_callback(
+                        lambda f, name=name, callback=callback:
+                            callback(name, f.exception() if f.exception() is not None else f.result()))
+                heapq.heappush(self.polls, (max(t_next + period, now), seq, name, method, period, callback))
+
+    def metrics(self):
+        'per instrument counters'
+        return OrderedDict((name, inst.metrics()) for name, inst in self.instruments.items())
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.poll_cond.notify()
+        self.pool.shutdown(wait=True)
+        for inst in list(self.instruments.values()):
+            inst.remcon.close()
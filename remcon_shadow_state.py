@@ -0,0 +1,151 @@
+'''
+Shadow copy of Remcon32 settings that can be written but not read back
+(gun alignment, beam shift, macro driven modes like high current)
+
+Every acknowledged write is stored with a timestamp and saved to disk
+atomically, so the values survive app restarts and can be re-applied
+after a reconnect. Saves are at most every save_interval s (eg beam shift
+written every second by drift correction), call flush() before closing.
+'''
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class RemconShadowState(object):
+
+    def __init__(self, fname=None, save_interval=5.0):
+        self.fname = fname
+        self.save_interval = save_interval
+        self.state = dict() # name -> (value, timestamp)
+        self.lock = threading.Lock()
+        self.last_save = 0.0
+        self.save_timer = None
+        if fname is not None:
+            self.load(fname)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with self.lock:
+            self.state.clear()
+            if not self.fname or not os.path.exists(self.fname):
+                return
+            try:
+                with open(self.fname, 'r') as f:
+                    saved = json.load(f)
+            except (IOError, ValueError) as err:
+                print("RemconShadowState: could not load {}: {}".format(self.fname, err))
+                return
+            for name, entry in saved.items():
+                self.state[name] = (entry['value'], entry['time'])
+
+    def save(self):
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            self.last_save = time.time()
+            if not self.fname:
+                return
+            saved = {name: dict(value=val, time=t) for name, (val, t) in self.state.items()}
+        save_json(self.fname, saved, indent=1)
+
+    def save_later(self):
+        'save now if the last save is save_interval old, else once it is'
+        with self.lock:
+            wait = self.last_save + self.save_interval - time.time()
+            if wait > 0:
+                if self.save_timer is None:
+                    self.save_timer = threading.Timer(wait, self.save)
+                    self.save_timer.daemon = True
+                    self.save_timer.start()
+                return
+        self.save()
+
+    def flush(self):
+        'save now if a save is pending'
+        if self.save_timer is not None:
+            self.save()
+
+    def record(self, name, val):
+        'call after hardware acknowledged the write'
+        with self.lock:
+            self.state[name] = (to_plain(val), time.time())
+        self.save_later()
+
+    def forget(self, name):
+        with self.lock:
+            self.state.pop(name, None)
+        self.save()
+
+    def get(self, name, default=None):
+        entry = self.state.get(name)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def age(self, name):
+        'seconds since last write, None if never written'
+        entry = self.state.get(name)
+        if entry is None:
+            return None
+        return time.time() - entry[1]
+
+    def is_applied(self, name, val, max_age=None):
+        '''True if val is the last value written, optionally only if written
+        less than max_age seconds ago'''
+        entry = self.state.get(name)
+        if entry is None:
+            return False
+        if max_age is not None and time.time() - entry[1] > max_age:
+            return False
+        return values_equal(entry[0], to_plain(val))
+
+    def __contains__(self, name):
+        return name in self.state
+
+    def as_dict(self):
+        return {name: val for name, (val, t) in self.state.items()}
+
+
+def save_json(fname, obj, indent=None):
+    '''
+    write obj as json to a temp file in the same directory, then rename,
+    never leaves a partial file
+    '''
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmp_fname = tempfile.mkstemp(prefix='.' + os.path.basename(fname) + '_', suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, fname)
+    except Exception:
+        os.remove(tmp_fname)
+        raise
+
+
+def to_plain(val):
+    # numpy arrays and scalars to json friendly python types
+    if hasattr(val, 'tolist'):
+        return val.tolist()
+    if isinstance(val, tuple):
+        return [to_plain(v) for v in val]
+    if isinstance(val, dict):
+        return {k: to_plain(v) for k, v in val.items()}
+    return val
+
+
+def values_equal(a, b, tol=1e-9):
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(values_equal(x, y, tol) for x, y in zip(a, b))
+    if isinstance(a, float) or isinstance(b, float):
+        try:
+            return abs(float(a) - float(b)) <= tol
+        except (TypeError, ValueError):
+            return False
+    return a == b
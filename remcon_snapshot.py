@@ -0,0 +1,38 @@
+'''
+Immutable record of the microscope state at acquisition time, see
+SEM_Remcon_HW.snapshot
+'''
+from collections import namedtuple
+
+snapshot_fields = ('time', 'latency', 'SEM_mode',
+                   'kV', 'eht_on', 'beam_blanking', 'external_scan',
+                   'magnification', 'full_size', 'pixel_size', 'WD',
+                   'stig_xy', 'aperture_xy', 'select_aperture',
+                   'gun_xy', 'beamshift_xy', 'high_current', 'dual_channel', 'probe_current',
+                   'detector0', 'detector1', 'contrast0', 'contrast1',
+                   'scm_state', 'scm_current', 'stage_position')
+
+
+class RemconSnapshot(namedtuple('RemconSnapshot', snapshot_fields)):
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, d):
+        vals = []
+        for name in cls._fields:
+            v = d.get(name)
+            if hasattr(v, 'tolist'):
+                v = v.tolist()
+            if isinstance(v, list):
+                v = tuple(v)
+            vals.append(v)
+        return cls(*vals)
+
+    def to_h5_attrs(self, h5_obj, prefix=''):
+        'write fields as attributes of an h5py group or dataset, None fields are skipped'
+        for name, v in zip(self._fields, self):
+            if v is not None:
+                h5_obj.attrs[prefix + name] = v
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
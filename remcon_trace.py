@@ -0,0 +1,121 @@
+'''
+Optional timeline tracing of hardware activity
+
+    from .remcon_trace import tracer
+    with tracer.span('set_wd', 'serial', val=9.2):
+        ...
+
+Spans that do not fit a with block (eg a stage move, from c95 to the
+stopped poll) use begin() and end():
+
+    span = tracer.begin('stage_move', 'stage')
+    ...
+    span.end()
+
+Finished spans go into a bounded deque (append is atomic, no lock taken)
+and can be exported as Chrome / Perfetto trace json (chrome://tracing,
+ui.perfetto.dev). With tracer.enabled False, span() returns a shared no-op
+context manager.
+'''
+import collections
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def end(self):
+        pass
+
+_null_span = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('tracer', 'name', 'cat', 'args', 't0', 'tid')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        # shown on the thread that started it, end() may come from another
+        T = self.tracer
+        self.tid = tid = threading.get_ident()
+        if tid not in T.thread_names:
+            T.thread_names[tid] = threading.current_thread().name
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        t1 = time.perf_counter()
+        T = self.tracer
+        tid = self.tid
+        if exc_type is not None:
+            self.args['error'] = repr(exc)
+        T.events.append((self.name, self.cat, self.t0, t1 - self.t0, tid, self.args))
+        return False
+
+    def end(self):
+        self.__exit__(None, None, None)
+
+
+class Tracer(object):
+
+    def __init__(self, maxlen=200000):
+        self.enabled = False
+        self.events = collections.deque(maxlen=maxlen)
+        self.thread_names = dict()
+        self.t_origin = time.perf_counter()
+
+    def span(self, name, cat='remcon', **args):
+        if not self.enabled:
+            return _null_span
+        return _Span(self, name, cat, args)
+
+    def begin(self, name, cat='remcon', **args):
+        'started span, call its end() when done'
+        return self.span(name, cat, **args).__enter__()
+
+    def instant(self, name, cat='remcon', **args):
+        if self.enabled:
+            self.events.append((name, cat, time.perf_counter(), None, threading.get_ident(), args))
+
+    def clear(self):
+        self.events.clear()
+        self.t_origin = time.perf_counter()
+
+    def chrome_trace(self):
+        'events as Chrome trace format dict'
+        pid = os.getpid()
+        out = []
+        for tid, tname in list(self.thread_names.items()):
+            out.append(dict(name='thread_name', ph='M', pid=pid, tid=tid, args=dict(name=tname)))
+        for name, cat, t0, dur, tid, args in list(self.events):
+            ev = dict(name=name, cat=cat, pid=pid, tid=tid,
+                      ts=(t0 - self.t_origin)*1e6,
+                      args={k: str(v) for k, v in args.items()})
+            if dur is None:
+                ev.update(ph='i', s='t')
+            else:
+                ev.update(ph='X', dur=dur*1e6)
+            out.append(ev)
+        return dict(traceEvents=out, displayTimeUnit='ms')
+
+    def export_chrome(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# shared by all instruments and measurements in the process
+tracer = Tracer()
@@ -10,6 +10,8 @@ import csv
 import time
 from ScopeFoundry.helper_funcs import sibling_path, load_qt_ui_file
 import configparser
+from .remcon_trace import tracer
+from .recipe_scheduler import RecipeSwitchCost, schedule_jobs
 
 ### on init
 
@@ -58,10 +60,16 @@ class SEMRecipeControlMeasure(Measurement):
                               ro=True)
             
         self.settings.New('recipe_date_modified', dtype=str, ro=True)
+        self.settings.New('eht_settled', dtype=bool, initial=True, ro=True)
+        self.settings.New('switch_cost_file', dtype='file', initial='recipe_switch_times.json')
         
         
         # list of recipe dicts
         self.recipes = []
+        # concurrent.futures.Future, done when EHT reached recipe kV
+        self.eht_future = None
+        # per setting change times, learned from execute_current_recipe
+        self.switch_cost = RecipeSwitchCost(hw.eht_tracker, fname=self.settings['switch_cost_file'])
                 
 
     def setup_figure(self):
@@ -227,14 +235,51 @@ class SEMRecipeControlMeasure(Measurement):
     def execute_current_recipe(self):
         # save first?
         # ask first?
-        for setting_name in self.recipe_remcon_settings:
-            self.remcon_hw.settings[setting_name] = self.settings['recipe_'+setting_name]
+        with tracer.span('execute_recipe', 'recipe', recipe=self.settings['recipe_name']):
+            for setting_name in self.recipe_remcon_settings:
+                new_val = self.settings['recipe_'+setting_name]
+                changed = self.remcon_hw.settings[setting_name] != new_val
+                t0 = time.time()
+                self.remcon_hw.settings[setting_name] = new_val
+                if changed and setting_name != 'kV':
+                    # WD, stig and aperture writes are coalesced, time until they reached the instrument
+                    self.remcon_hw.flush_writes()
+                    # kV ramp is timed by the EHT tracker
+                    self.switch_cost.record(setting_name, time.time() - t0)
+        self.switch_cost.save()
+        
+        # kV was written first, track the ramp without blocking the UI
+        self.settings['eht_settled'] = False
+        self.eht_future = self.remcon_hw.kV_settled_future()
+        self.eht_future.add_done_callback(self.on_eht_settled)
+
+    def on_eht_settled(self, future):
+        try:
+            print("recipe EHT settled after {:.2f} s".format(future.result()))
+        except IOError as err:
+            print("recipe EHT settle failed", err)
+        self.settings['eht_settled'] = True
 
     
     
+    def plan_jobs(self, jobs):
+        '''
+        reorder jobs (dicts with recipe, duration, optional priority and deadline)
+        to cut recipe switching time, starting from the current microscope state
+        returns (ordered jobs, report), see recipe_scheduler.schedule_jobs
+        '''
+        recipes = {r['name']: r for r in self.recipes}
+        current = {name: self.remcon_hw.settings[name] for name in self.recipe_remcon_settings}
+        ordered, report = schedule_jobs(jobs, recipes, self.switch_cost, start_recipe=current)
+        print("recipe job plan: switching {switch_time:.1f} s instead of {baseline_switch_time:.1f} s, "
+              "saves {time_saved:.1f} s, lateness {lateness:.1f} s".format(**report))
+        return ordered, report
+
     def on_save_recipe(self):
         new_name = self.ui.new_recipe_name_lineEdit.text()
         self.save_current_settings_as_recipe(new_name)
+        # saved recipes are aligned conditions, grow the alignment table with them
+        self.remcon_hw.record_alignment()
         
         
     
\ No newline at end of file
@@ -0,0 +1,148 @@
+'''
+Stage tiled montage acquisition
+
+Tiles an ROI (stage coordinates, mm) with frames of the current SEM field of
+view (sem_remcon full_size), visits tiles in serpentine order, starts the next
+stage move as soon as a frame is acquired and processes frames on a worker
+pool in parallel with motion.
+
+Acquisition and processing are user supplied:
+    measure.acquire_func(i, x, y) -> frame
+    measure.process_func(i, frame, row)    optional, runs on the worker pool
+'''
+from ScopeFoundry import Measurement
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import time
+
+from .remcon_trace import tracer
+
+
+class SEMStageMontage(Measurement):
+
+    name = 'sem_stage_montage'
+
+    index_columns = ['tile', 'ix', 'iy', 'x', 'y', 'x_read', 'y_read',
+                     't_move_start', 't_move_done', 't_acq_start', 't_acq_done']
+
+    def setup(self):
+
+        for ax in 'xy':
+            self.settings.New('roi_{}0'.format(ax), dtype=float, initial=0.0, unit='mm', spinbox_decimals=4)
+            self.settings.New('roi_{}1'.format(ax), dtype=float, initial=0.1, unit='mm', spinbox_decimals=4)
+        self.settings.New('overlap', dtype=float, initial=0.1, vmin=0.0, vmax=0.9)
+        self.settings.New('settle_time', dtype=float, initial=0.2, vmin=0.0, unit='s')
+        self.settings.New('move_timeout', dtype=float, initial=0.0, vmin=0.0, unit='s',
+                          description='0: from learned stage move-time model')
+        self.settings.New('n_workers', dtype=int, initial=2, vmin=1)
+        self.settings.New('index_filename', dtype='file', initial='montage_index.csv')
+        self.settings.New('n_tiles', dtype=int, initial=0, ro=True)
+        self.settings.New('eta', dtype=float, initial=0.0, ro=True, unit='s',
+                          description='predicted motion + settle time, excluding acquisition')
+
+        self.remcon = self.app.hardware['sem_remcon']
+
+        self.acquire_func = None
+        self.process_func = None
+
+        for lq_name in ['roi_x0', 'roi_x1', 'roi_y0', 'roi_y1', 'overlap', 'settle_time']:
+            self.settings.get_lq(lq_name).add_listener(self.update_n_tiles)
+        self.remcon.settings.full_size.add_listener(self.update_n_tiles)
+
+    def setup_figure(self):
+        self.ui = self.settings.New_UI()
+
+    def update_n_tiles(self):
+        tiles = self.compute_tiles()
+        self.settings['n_tiles'] = len(tiles)
+        self.settings['eta'] = self.estimate_time(tiles)
+
+    def estimate_time(self, tiles):
+        'predicted stage motion and settle time for the tour, s'
+        if len(tiles) == 0:
+            return 0.0
+        start = self.remcon.settings['stage_position'][:5]
+        poses = np.tile(start, (len(tiles), 1))
+        poses[:, 0:2] = tiles[:, 2:4]
+        legs = self.remcon.stage_model.predict_tour(poses, start=start)
+        return float(legs.sum() + len(tiles)*self.settings['settle_time'])
+
+    def compute_tiles(self):
+        '''
+        returns array of rows (ix, iy, x, y), tile centers in mm, in serpentine order
+        '''
+        S = self.settings
+        tile = self.remcon.settings['full_size'] * 1e3 # m -> mm
+        step = tile * (1.0 - S['overlap'])
+        centers = []
+        for ax in 'xy':
+            a0, a1 = sorted((S['roi_{}0'.format(ax)], S['roi_{}1'.format(ax)]))
+            n = max(1, int(np.ceil((a1 - a0 - tile) / step - 1e-9)) + 1)
+            # center the grid on the ROI
+            span = (n - 1) * step
+            centers.append(0.5*(a0 + a1) + np.arange(n)*step - 0.5*span)
+        xs, ys = centers
+        rows = []
+        for iy, y in enumerate(ys):
+            ix_order = range(len(xs)) if iy % 2 == 0 else range(len(xs) - 1, -1, -1)
+            for ix in ix_order:
+                rows.append((ix, iy, xs[ix], ys[iy]))
+        return np.array(rows, dtype=float).reshape(-1, 4)
+
+    def start_move(self, x, y):
+        self.remcon.remcon.set_stage_abs_xy_rot(x=x, y=y)
+        return time.time()
+
+    def run(self):
+        S = self.settings
+        if self.acquire_func is None:
+            raise ValueError("sem_stage_montage: set acquire_func before starting")
+        tiles = self.compute_tiles()
+        S['n_tiles'] = len(tiles)
+        index = np.full((len(tiles), len(self.index_columns)), np.nan)
+        futures = []
+        move_error = None
+
+        self.remcon.flush_writes()
+        t_move_start = self.start_move(tiles[0, 2], tiles[0, 3])
+        with ThreadPoolExecutor(max_workers=S['n_workers']) as pool:
+            for i, (ix, iy, x, y) in enumerate(tiles):
+                if self.interrupt_measurement_called:
+                    break
+                if not self.remcon.wait_until_stage_stopped(timeout=S['move_timeout'] or None):
+                    # a tile acquired here would be indexed at the wrong position
+                    move_error = IOError("sem_stage_montage: tile {} position not reached".format(i))
+                    break
+                t_move_done = time.time()
+                pos = self.remcon.settings['stage_position']
+                time.sleep(S['settle_time'])
+
+                t_acq_start = time.time()
+                with tracer.span('acquire_tile', 'montage', i=i):
+                    frame = self.acquire_func(i, x, y)
+                t_acq_done = time.time()
+
+                # frame is in, next move overlaps with processing and saving
+                next_move_start = np.nan
+                if i + 1 < len(tiles):
+                    next_move_start = self.start_move(tiles[i+1, 2], tiles[i+1, 3])
+
+                index[i] = (i, ix, iy, x, y, pos[0], pos[1],
+                            t_move_start, t_move_done, t_acq_start, t_acq_done)
+                t_move_start = next_move_start
+                if self.process_func is not None:
+                    futures.append(pool.submit(self.process_func, i, frame, index[i].copy()))
+                self.set_progress(100.0 * (i + 1) / len(tiles))
+
+            for f in futures:
+                f.result() # re-raise processing errors
+
+        self.save_index(index[~np.isnan(index[:, 0])])
+        if move_error is not None:
+            raise move_error
+
+    def save_index(self, index):
+        np.savetxt(self.settings['index_filename'], index, delimiter=',', fmt='%.6f',
+                   header='full_size={:g} overlap={:g}\n'.format(
+                       self.remcon.settings['full_size'], self.settings['overlap'])
+                   + ','.join(self.index_columns))
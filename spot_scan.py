@@ -0,0 +1,124 @@
+'''
+Batched spot mode point acquisition for CL / Auger point grids
+
+Positions the beam with the Remcon32 'spot' command (1024 x 768 raster) at
+each point of an array, with per point dwell. The next spot command is sent
+early by the measured command latency, so it is acknowledged when the
+previous dwell ends. Command strings are built up front so the per point
+Python work in the loop is just the serial transaction.
+
+The spot command acknowledge is taken as the moment the beam arrives.
+'''
+import time
+
+import numpy as np
+
+
+def order_points(points, method='nearest'):
+    '''
+    returns index array visiting points to reduce deflection jumps
+    method: 'nearest' greedy nearest neighbour, 'serpentine' by raster row
+        alternating direction, None keeps the given order
+    '''
+    pts = np.asarray(points, dtype=float)
+    n = len(pts)
+    if method is None or n < 3:
+        return np.arange(n)
+    if method == 'serpentine':
+        rows = np.unique(pts[:, 1])
+        order = []
+        for k, y in enumerate(rows):
+            idx = np.nonzero(pts[:, 1] == y)[0]
+            idx = idx[np.argsort(pts[idx, 0])]
+            order.append(idx if k % 2 == 0 else idx[::-1])
+        return np.concatenate(order)
+    if method == 'nearest':
+        remaining = np.ones(n, dtype=bool)
+        order = np.empty(n, dtype=int)
+        current = 0
+        for k in range(n):
+            order[k] = current
+            remaining[current] = False
+            if k == n - 1:
+                break
+            d2 = ((pts - pts[current])**2).sum(axis=1)
+            d2[~remaining] = np.inf
+            current = int(np.argmin(d2))
+        return order
+    raise ValueError("unknown point order method {}".format(method))
+
+
+def sleep_until(t_target):
+    # time.sleep overshoots by ~1 ms or more on Windows, spin for the last bit
+    while True:
+        remaining = t_target - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > 0.002:
+            time.sleep(remaining - 0.0015)
+
+
+class SpotScanEngine(object):
+
+    def __init__(self, remcon, acquire_func=None, restore_normal=True):
+        '''
+        remcon: Remcon32 instance
+        acquire_func: optional callable(i, x, y, dwell) called when the beam
+            arrives at point i, should trigger acquisition and return quickly
+        restore_normal: send 'norm' (set_norm) when done
+        '''
+        self.remcon = remcon
+        self.acquire_func = acquire_func
+        self.restore_normal = restore_normal
+        self.latency = 0.03 # s, initial guess, updated from measured round trips
+
+    def run(self, points, dwell, order='nearest'):
+        '''
+        points: (N, 2) array of raster x (0-1023), y (0-767)
+        dwell: s, scalar or length N
+        returns dict of arrays in visit order: index, x, y, dwell and
+            t_send, t_ack (beam arrives), t_end (beam leaves), relative to start
+        '''
+        R = self.remcon
+        pts = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(pts)
+        dwell = np.broadcast_to(np.asarray(dwell, dtype=float), (n,))
+        idx = order_points(pts, order)
+
+        xi = np.clip(np.rint(pts[idx, 0]), 0, 1023).astype(int)
+        yi = np.clip(np.rint(pts[idx, 1]), 0, 767).astype(int)
+        dw = np.array(dwell[idx])
+        cmds = ['spot {} {}'.format(x, y) for x, y in zip(xi, yi)]
+
+        t_send = np.zeros(n)
+        t_ack = np.zeros(n)
+        t_end = np.zeros(n)
+        t0 = time.perf_counter()
+        t_dwell_end = None
+        latency = self.latency
+        try:
+            for k in range(n):
+                if t_dwell_end is not None:
+                    sleep_until(t_dwell_end - latency)
+                ts = time.perf_counter()
+                R.cmd_response(cmds[k])
+                ta = time.perf_counter()
+                latency = 0.8*latency + 0.2*(ta - ts)
+                if k > 0:
+                    t_end[k-1] = ta - t0
+                t_send[k] = ts - t0
+                t_ack[k] = ta - t0
+                if self.acquire_func is not None:
+                    self.acquire_func(int(idx[k]), xi[k], yi[k], dw[k])
+                t_dwell_end = ta + dw[k]
+            if n:
+                sleep_until(t_dwell_end)
+                t_end[n-1] = time.perf_counter() - t0
+        finally:
+            self.latency = latency
+            if self.restore_normal:
+                R.set_norm()
+
+        return dict(index=idx, x=xi, y=yi, dwell=dw,
+                    t_send=t_send, t_ack=t_ack, t_end=t_end,
+                    dwell_actual=t_end - t_ack, latency=latency)
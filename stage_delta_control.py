@@ -65,12 +65,14 @@ class SEMStageDeltaControl(Measurement):
 
         mm_step = {'1um':1e-3 , '10um': 10e-3, '100um': 100e-3, '1mm':1.0, '10mm':10.0}[step]
 
-        # safety logic here
+        # large steps can swing the holder under a detector or the pole piece
         if mm_step >  0.1:
-            # check Z
-                
-            pass
-                
+            start = self.remcon.remcon.get_stage_position()[:5]
+            target = list(start)
+            target['xy'.index(ax)] += int_dir*mm_step
+            if not self.remcon.stage_envelope.check_move(start, target):
+                print("step_xy: move to {} outside stage envelope, lower z first".format(target))
+                return
 
         # Initiate move
         if ax == 'x':
@@ -93,7 +95,13 @@ class SEMStageDeltaControl(Measurement):
     
         mm_step = {'0.1um':0.1e-3, '1um':1e-3 , '10um': 10e-3, '100um': 100e-3, '1mm':1.0}[step]
 
-        # safety logic here
+        if int_dir > 0:
+            start = self.remcon.remcon.get_stage_position()[:5]
+            target = list(start)
+            target[2] += mm_step
+            if not self.remcon.stage_envelope.check_move(start, target):
+                print("step_z: z {:.4f} above stage envelope".format(target[2]))
+                return
         
         self.remcon.remcon.set_stage_delta(z=int_dir*mm_step)
         
@@ -120,22 +128,10 @@ class SEMStageDeltaControl(Measurement):
         self.remcon.settings.stage_position.read_from_hardware()
 
 
-    def wait_until_move_complete(self,timeout=5.0):
-        import time
-        t0 = time.time()
-        while True:
-            self.app.qtapp.processEvents()
-            time.sleep(0.01)
-            if time.time() - t0 > timeout:
-                print("sem stage timeout occurred")
-                break
-            self.remcon.settings.stage_position.read_from_hardware()
-            #if not self.remcon.remcon.get_stage_moving():
-            #    print("done moving")
-            #    break
-            if not self.remcon.settings['stage_is_moving']:
-                print("done moving")
-                break
+    def wait_until_move_complete(self,timeout=None):
+        # sleep/poll schedule and timeout come from the learned stage move-time model
+        if self.remcon.wait_until_stage_stopped(timeout=timeout, idle_func=self.app.qtapp.processEvents):
+            print("done moving")
         time.sleep(0.01)
         self.remcon.settings.stage_position.read_from_hardware()
 
@@ -146,24 +142,16 @@ class SEMStageDeltaControl(Measurement):
         
         print("move_to_insert_position")
         self.remcon.settings.stage_position.read_from_hardware()
-        z = self.remcon.settings['stage_z']
-
-
-        # drop z if too close
-        if z > self.insert['z']:
-            print("move_to_insert_position: dropping z")
-
-            self.remcon.remcon.set_stage_position_kwargs(z=self.insert['z'])
-            self.wait_until_move_complete(timeout=30.0)
 
-        # move to insert position
+        # move to insert position, z is only retracted first if the envelope requires it
         print("move_to_insert_position: initiate move")
         
         rot_targets = self.remcon.remcon.check_rotation_fault(self.remcon.settings['stage_rot'], self.insert['rot'])
         for rot_pos in rot_targets:
             I = self.insert
-            self.remcon.remcon.set_stage_position_kwargs(x=I['x'], y=I['y'], z=I['z'], rot=rot_pos)
-            self.wait_until_move_complete(timeout=30.0)
+            n_legs = self.remcon.safe_move(x=I['x'], y=I['y'], z=I['z'], rot=rot_pos,
+                                           idle_func=self.app.qtapp.processEvents)
+            print("move_to_insert_position: {} leg(s) to rot {}".format(n_legs, rot_pos))
         
         # verify position
         print("move_to_insert_position: move done")
@@ -0,0 +1,157 @@
+'''
+Stage collision envelope and move planner
+
+Stage z increases towards the pole piece. The highest safe z at a stage
+pose is the chamber z limit, lowered by the sample height, by the rise of
+the holder edge when tilted (radius * sin|tilt|) and by keep-out zones
+(detectors etc) in stage xy where the holder footprint overlaps them.
+
+A c95 move drives all axes at once at their own speeds, so the path between
+two poses is not a straight line. check_move tests the worst case: z at the
+higher end point and the largest |tilt|, over a grid covering the whole xy
+box between start and target. plan_move moves in one go when that is safe
+and otherwise adds a Z retract to the highest z that is safe over the box.
+Until an envelope file is loaded, plan_move does not trust the default
+limits and always lowers z before moving the other axes.
+
+Configured per instrument in an ini file:
+
+    [limits]
+    x_min = 0
+    x_max = 130
+    ...
+    [holder]
+    radius = 25.0
+    height = 0.0
+    margin = 0.5
+    [zone:eds]
+    x = 120
+    y = 65
+    radius = 15
+    z_max = 35
+'''
+import configparser
+import os
+
+import numpy as np
+
+
+class StageEnvelope(object):
+
+    default_limits = dict(x_min=0.0, x_max=130.0, y_min=0.0, y_max=130.0,
+                          z_min=0.0, z_max=50.0, tilt_min=-4.0, tilt_max=70.0)
+
+    def __init__(self, fname=None, grid=32):
+        '''
+        grid: samples per xy axis for move checks
+        '''
+        self.fname = fname
+        self.grid = grid
+        self.limits = dict(self.default_limits)
+        self.holder_radius = 25.0
+        self.holder_height = 0.0
+        self.margin = 0.5
+        # (name, x, y, radius, z_max)
+        self.zones = []
+        # False while only the default limits are known
+        self.configured = False
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        config = configparser.ConfigParser()
+        config.read(self.fname)
+        if config.has_section('limits'):
+            for key, val in config.items('limits'):
+                self.limits[key] = float(val)
+        if config.has_section('holder'):
+            h = config['holder']
+            self.holder_radius = h.getfloat('radius', self.holder_radius)
+            self.holder_height = h.getfloat('height', self.holder_height)
+            self.margin = h.getfloat('margin', self.margin)
+        self.zones = []
+        for section in config.sections():
+            if section.startswith('zone:'):
+                z = config[section]
+                self.zones.append((section[5:], z.getfloat('x'), z.getfloat('y'),
+                                   z.getfloat('radius'), z.getfloat('z_max')))
+        self.configured = True
+
+    def z_max(self, x, y, tilt):
+        'highest safe stage z at (x, y, tilt), vectorized'
+        x, y, tilt = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (x, y, tilt)))
+        zmax = (self.limits['z_max'] - self.holder_height - self.margin
+                - self.holder_radius*np.sin(np.radians(np.abs(tilt))))
+        for name, zx, zy, zr, zone_zmax in self.zones:
+            inside = np.hypot(x - zx, y - zy) < zr + self.holder_radius
+            zmax = np.where(inside, np.minimum(zmax, zone_zmax - self.holder_height - self.margin), zmax)
+        return zmax
+
+    def in_limits(self, pose):
+        x, y, z, tilt = pose[:4]
+        L = self.limits
+        return (L['x_min'] <= x <= L['x_max'] and L['y_min'] <= y <= L['y_max']
+                and L['z_min'] <= z and L['tilt_min'] <= tilt <= L['tilt_max'])
+
+    def pose_ok(self, pose):
+        return self.in_limits(pose) and pose[2] <= float(self.z_max(pose[0], pose[1], pose[3]))
+
+    def box_z_max(self, start, target):
+        'highest z that is safe anywhere in the xy box and tilt range of a move'
+        X = np.linspace(start[0], target[0], self.grid if start[0] != target[0] else 1)
+        Y = np.linspace(start[1], target[1], self.grid if start[1] != target[1] else 1)
+        t0, t1 = start[3], target[3]
+        # holder edge rises most at whichever end has the larger |tilt|
+        worst_tilt = max(abs(t0), abs(t1))
+        return float(self.z_max(X[:, None], Y[None, :], worst_tilt).min())
+
+    def check_move(self, start, target):
+        'True if a direct move start -> target (x, y, z, tilt, ...) is safe'
+        if not (self.in_limits(start) and self.in_limits(target)):
+            return False
+        return max(start[2], target[2]) <= self.box_z_max(start, target)
+
+    def plan_move(self, start, target):
+        '''
+        list of poses (x, y, z, tilt, rot) to visit in order to get from start to target,
+        the target alone if the direct move is safe
+        raises ValueError if the target itself is outside the envelope
+        '''
+        start = [float(v) for v in start[:5]]
+        target = [float(v) for v in target[:5]]
+        if not self.configured:
+            return self.plan_retract_first(start, target)
+        if not self.pose_ok(target):
+            raise ValueError("stage target {} outside safe envelope".format(target))
+        if self.check_move(start, target):
+            return [target]
+        z_safe = min(start[2], target[2], self.box_z_max(start, target))
+        if z_safe < self.limits['z_min']:
+            raise ValueError("no safe z for stage move {} -> {}".format(start, target))
+        legs = []
+        if start[2] > z_safe:
+            # lowering z alone never reduces clearance
+            legs.append(start[:2] + [z_safe] + start[3:])
+        legs.append(target[:2] + [z_safe] + target[3:])
+        if target[2] > z_safe:
+            legs.append(target)
+        return legs
+
+    @staticmethod
+    def plan_retract_first(start, target):
+        '''
+        conservative sequence without an envelope: z down to the lower of start
+        and target z, other axes at that z, z up last
+        '''
+        start = [float(v) for v in start[:5]]
+        target = [float(v) for v in target[:5]]
+        z_low = min(start[2], target[2])
+        legs = []
+        if start[2] > z_low:
+            legs.append(start[:2] + [z_low] + start[3:])
+        legs.append(target[:2] + [z_low] + target[3:])
+        if target[2] > z_low:
+            legs.append(target)
+        return legs
@@ -0,0 +1,122 @@
+'''
+Learned stage move-time model
+
+Each axis moves with a trapezoidal velocity profile (acceleration,
+velocity) followed by a settle time, axes move together so a move takes as
+long as its slowest axis. Parameters are fitted per axis from observed
+moves (start pose, target pose, duration) and saved per instrument as json.
+'''
+import json
+import os
+import threading
+
+import numpy as np
+
+from .remcon_shadow_state import save_json
+
+
+class StageMotionModel(object):
+
+    axes = ('x', 'y', 'z', 'tilt', 'rot')
+    # mm or deg: velocity /s, acceleration /s^2, settle s; starting guesses until fitted
+    default_params = {'x':    (2.0, 4.0, 0.3),
+                      'y':    (2.0, 4.0, 0.3),
+                      'z':    (0.5, 1.0, 0.3),
+                      'tilt': (2.0, 4.0, 0.5),
+                      'rot':  (10.0, 20.0, 0.5)}
+
+    def __init__(self, fname=None, history_len=500):
+        self.fname = fname
+        self.history_len = history_len
+        self.params = {ax: self.default_params[ax] for ax in self.axes}
+        self.history = [] # (start[5], target[5], duration)
+        self.lock = threading.Lock()
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def load(self, fname=None):
+        if fname is not None:
+            self.fname = fname
+        with open(self.fname, 'r') as f:
+            d = json.load(f)
+        self.params.update({ax: tuple(p) for ax, p in d['params'].items()})
+        self.history = [(h[0], h[1], h[2]) for h in d['history']]
+
+    def save(self):
+        if not self.fname:
+            return
+        save_json(self.fname, dict(params=self.params, history=self.history))
+
+    @staticmethod
+    def distances(start, target):
+        'absolute per axis distances, rotation the short way round'
+        d = np.abs(np.asarray(target, dtype=float)[..., :5] - np.asarray(start, dtype=float)[..., :5])
+        d[..., 4] = np.minimum(d[..., 4] % 360.0, 360.0 - d[..., 4] % 360.0)
+        return d
+
+    @staticmethod
+    def profile_time(d, v, a):
+        'trapezoidal (triangular for short moves) profile time, vectorized'
+        d = np.asarray(d, dtype=float)
+        return np.where(d < v*v/a, 2*np.sqrt(d/a), d/v + v/a)
+
+    def axis_times(self, d):
+        t = np.zeros(np.shape(d))
+        for i, ax in enumerate(self.axes):
+            v, a, settle = self.params[ax]
+            di = d[..., i]
+            t[..., i] = np.where(di > 1e-6, self.profile_time(di, v, a) + settle, 0.0)
+        return t
+
+    def predict(self, start, target):
+        'predicted move duration (s)'
+        return float(self.axis_times(self.distances(start, target)).max())
+
+    def predict_tour(self, poses, start=None):
+        '''
+        poses: (N, 5) stage poses visited in order, start: current pose
+        returns array of N leg durations (s), sum for the tour ETA
+        '''
+        poses = np.asarray(poses, dtype=float)[:, :5]
+        if start is None:
+            start = poses[0]
+        prev = np.vstack([np.asarray(start, dtype=float)[None, :5], poses[:-1]])
+        return self.axis_times(self.distances(prev, poses)).max(axis=1)
+
+    def record(self, start, target, duration, refit=True):
+        with self.lock:
+            self.history.append((list(map(float, start[:5])), list(map(float, target[:5])),
+                                 float(duration)))
+            del self.history[:-self.history_len]
+        if refit:
+            self.fit()
+        self.save()
+
+    def fit(self, min_samples=5):
+        '''
+        for each axis, grid search (v, a) over moves where that axis dominates,
+        settle is the median remaining time
+        '''
+        with self.lock:
+            if len(self.history) < min_samples:
+                return self.params
+            start = np.array([h[0] for h in self.history])
+            target = np.array([h[1] for h in self.history])
+            duration = np.array([h[2] for h in self.history])
+        d = self.distances(start, target)
+        dominant = np.argmax(self.axis_times(d), axis=1)
+        for i, ax in enumerate(self.axes):
+            sel = dominant == i
+            if sel.sum() < min_samples:
+                continue
+            di, ti = d[sel, i], duration[sel]
+            v0, a0, s0 = self.params[ax]
+            v_grid = v0 * np.logspace(-1, 1, 41)
+            a_grid = a0 * np.logspace(-1, 1, 41)
+            V, A = np.meshgrid(v_grid, a_grid, indexing='ij')
+            t = self.profile_time(di[None, None, :], V[..., None], A[..., None]) # (41, 41, n)
+            settle = np.median(ti - t, axis=2).clip(0, None)
+            err = np.median(np.abs(ti - t - settle[..., None]), axis=2)
+            j, k = np.unravel_index(np.argmin(err), err.shape)
+            self.params[ax] = (float(V[j, k]), float(A[j, k]), float(settle[j, k]))
+        return self.params
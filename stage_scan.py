@@ -0,0 +1,235 @@
+'''
+Continuous-motion stage scanning
+
+Scans an ROI (stage coordinates, mm) in serpentine lines along x. Each line
+is one long c95 move; while the stage travels, a sampler thread reads c95?
+back to back (as fast as the link allows) and the run thread acquires
+frames continuously. Each frame is stamped with its start and end time,
+afterwards the times are interpolated into stage positions from the pose
+samples, so the stage's real motion (acceleration, speed) is used rather
+than the commanded path.
+
+    measure.acquire_func(line, k) -> frame     called repeatedly while moving
+    measure.process_func(line, k, frame, row)  optional, row is the index row
+                                               with interpolated position
+
+Result in measure.dataset: index array (columns index_columns), pose
+samples and, with keep_frames, the frames. The index is written to csv.
+'''
+from ScopeFoundry import Measurement
+import threading
+import time
+
+import numpy as np
+
+from .remcon_trace import tracer
+
+
+class _PoseSampler(object):
+    'reads stage pose back to back in a thread, time stamped at mid request'
+
+    def __init__(self, remcon):
+        self.remcon = remcon
+        self.samples = [] # (t, x, y, z, tilt, rot, status)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='stage_scan_sampler')
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                t0 = time.time()
+                pos = self.remcon.get_stage_position()
+                t1 = time.time()
+                self.samples.append((0.5*(t0 + t1),) + tuple(pos[:5]) + (pos[6],))
+        except Exception as err:
+            # re-raised by the scan thread, see check()
+            self.error = err
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+
+class SEMStageScan(Measurement):
+
+    name = 'sem_stage_scan'
+
+    index_columns = ['line', 'frame', 't_start', 't_end', 'x', 'y',
+                     'x_start', 'y_start', 'x_end', 'y_end', 'extrapolated']
+
+    def setup(self):
+
+        for ax in 'xy':
+            self.settings.New('roi_{}0'.format(ax), dtype=float, initial=0.0, unit='mm', spinbox_decimals=4)
+            self.settings.New('roi_{}1'.format(ax), dtype=float, initial=0.1, unit='mm', spinbox_decimals=4)
+        self.settings.New('overlap', dtype=float, initial=0.1, vmin=0.0, vmax=0.9,
+                          description='line to line overlap, fraction of full_size')
+        self.settings.New('run_in', dtype=float, initial=0.05, vmin=0.0, unit='mm',
+                          description='extra travel at each line end for acceleration')
+        self.settings.New('line_timeout', dtype=float, initial=0.0, vmin=0.0, unit='s',
+                          description='0: from learned stage move-time model')
+        self.settings.New('keep_frames', dtype=bool, initial=True)
+        self.settings.New('index_filename', dtype='file', initial='stage_scan_index.csv')
+        self.settings.New('n_lines', dtype=int, initial=0, ro=True)
+        self.settings.New('pose_rate', dtype=float, initial=0.0, ro=True, unit='Hz')
+
+        self.remcon = self.app.hardware['sem_remcon']
+
+        self.acquire_func = None
+        self.process_func = None
+        self.dataset = None
+
+        for lq_name in ['roi_y0', 'roi_y1', 'overlap']:
+            self.settings.get_lq(lq_name).add_listener(self.update_n_lines)
+        self.remcon.settings.full_size.add_listener(self.update_n_lines)
+
+    def setup_figure(self):
+        self.ui = self.settings.New_UI()
+
+    def update_n_lines(self):
+        self.settings['n_lines'] = len(self.compute_lines())
+
+    def compute_lines(self):
+        '''
+        returns array of rows (y, x_from, x_to) in mm, serpentine
+        '''
+        S = self.settings
+        pitch = self.remcon.settings['full_size'] * 1e3 * (1.0 - S['overlap'])
+        x0, x1 = sorted((S['roi_x0'], S['roi_x1']))
+        y0, y1 = sorted((S['roi_y0'], S['roi_y1']))
+        n = max(1, int(np.ceil((y1 - y0) / pitch - 1e-9)) + 1) if pitch > 0 else 1
+        ys = 0.5*(y0 + y1) + (np.arange(n) - 0.5*(n - 1))*pitch
+        x0, x1 = x0 - S['run_in'], x1 + S['run_in']
+        return np.array([(y, x0, x1) if i % 2 == 0 else (y, x1, x0)
+                         for i, y in enumerate(ys)], dtype=float).reshape(-1, 3)
+
+    def scan_line(self, line, y, x_from, x_to):
+        '''
+        move to line start, then acquire frames during one move to the line end
+        returns (frames, frame times (n, 2), pose samples (m, 7))
+        '''
+        hw = self.remcon
+        R = hw.remcon
+        R.set_stage_abs_xy_rot(x=x_from, y=y)
+        if not hw.wait_until_stage_stopped():
+            raise IOError("stage_scan: line {} start not reached".format(line))
+
+        start = list(R.last_stage_position[:5])
+        target = list(start)
+        target[0] = x_to
+        timeout = self.settings['line_timeout']
+        if not timeout:
+            timeout = hw.settings['stage_fault_factor']*hw.stage_model.predict(start, target) + 5.0
+
+        sampler = _PoseSampler(R)
+        frames = []
+        times = []
+        with tracer.span('scan_line', 'stage_scan', line=line):
+            sampler.start()
+            try:
+                R.set_stage_abs_xy_rot(x=x_to)
+                t_cmd = time.time()
+                moving_seen = False
+                t_stop = None
+                k = 0
+                while not self.interrupt_measurement_called:
+                    t0 = time.time()
+                    frame = self.acquire_func(line, k)
+                    t1 = time.time()
+                    frames.append(frame)
+                    times.append((t0, t1))
+                    k += 1
+                    sampler.check()
+                    if t1 - t_cmd > timeout:
+                        hw.settings['stage_move_fault'] = True
+                        raise IOError("stage_scan: line {} took longer than {:.1f} s".format(line, timeout))
+                    s = sampler.last()
+                    if s is None or s[0] < t_cmd:
+                        continue
+                    if s[6]:
+                        moving_seen = True
+                    # motion flag may lag the c95 command, also accept arrival at the line end
+                    elif moving_seen or abs(s[1] - x_to) < 1e-3:
+                        t_stop = s[0]
+                        break
+            finally:
+                sampler.stop()
+        if t_stop is not None:
+            # an interrupted line is still moving, it is not a completed move for the model
+            hw.finish_stage_move(t_stop, learn=moving_seen)
+        return frames, np.array(times).reshape(-1, 2), np.array(sampler.samples).reshape(-1, 7)
+
+    @staticmethod
+    def interpolate_positions(times, samples):
+        '''
+        times: (n, 2) frame start, end; samples: (m, 7) pose samples
+        returns (n, 7) x, y at frame mid, x, y at start, x, y at end, extrapolated flag
+        '''
+        t = samples[:, 0]
+        out = np.zeros((len(times), 7))
+        mid = times.mean(axis=1)
+        for j, tt in enumerate((mid, times[:, 0], times[:, 1])):
+            out[:, 2*j] = np.interp(tt, t, samples[:, 1])
+            out[:, 2*j+1] = np.interp(tt, t, samples[:, 2])
+        # outside the sampled interval np.interp holds the end value
+        out[:, 6] = (times[:, 0] < t[0]) | (times[:, 1] > t[-1])
+        return out
+
+    def run(self):
+        S = self.settings
+        if self.acquire_func is None:
+            raise ValueError("sem_stage_scan: set acquire_func before starting")
+        lines = self.compute_lines()
+        self.remcon.flush_writes()
+
+        index_rows = []
+        all_samples = []
+        all_frames = []
+        n_samples, t_sampling = 0, 0.0
+        for line, (y, x_from, x_to) in enumerate(lines):
+            if self.interrupt_measurement_called:
+                break
+            frames, times, samples = self.scan_line(line, y, x_from, x_to)
+            if len(samples) < 2 or len(frames) == 0:
+                print("stage_scan: line {} has too few pose samples, skipped".format(line))
+                continue
+            n_samples += len(samples)
+            t_sampling += samples[-1, 0] - samples[0, 0]
+            S['pose_rate'] = n_samples / max(t_sampling, 1e-9)
+            pos = self.interpolate_positions(times, samples)
+            rows = np.column_stack([np.full(len(frames), line), np.arange(len(frames)), times, pos])
+            for k, frame in enumerate(frames):
+                if self.process_func is not None:
+                    self.process_func(line, k, frame, rows[k].copy())
+            index_rows.append(rows)
+            all_samples.append(np.column_stack([np.full(len(samples), line), samples]))
+            if S['keep_frames']:
+                all_frames += frames
+            self.set_progress(100.0 * (line + 1) / len(lines))
+
+        index = np.vstack(index_rows) if index_rows else np.zeros((0, len(self.index_columns)))
+        self.dataset = dict(index=index,
+                            pose_samples=np.vstack(all_samples) if all_samples else np.zeros((0, 8)),
+                            frames=all_frames if S['keep_frames'] else None,
+                            columns=list(self.index_columns))
+        self.save_index(index)
+
+    def save_index(self, index):
+        np.savetxt(self.settings['index_filename'], index, delimiter=',', fmt='%.6f',
+                   header='full_size={:g} overlap={:g}\n'.format(
+                       self.remcon.settings['full_size'], self.settings['overlap'])
+                   + ','.join(self.index_columns))
@@ -0,0 +1,179 @@
+'''
+Columnar telemetry archive of polled microscope parameters
+
+One directory per parameter under path, holding chunk files
+    <t_first>_<t_last>.npz    arrays t (s since epoch) and v (n_samples, n_values)
+    ds_<t_first>_<t_last>.npz same, downsampled
+Values are only recorded when they change. String valued parameters
+(detectors) are stored as integer codes, see categories.json. Queries open
+only the chunks overlapping the requested window, found from file names.
+Chunks older than downsample_age are downsampled from flush, at most once
+per downsample_interval.
+'''
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class TelemetryRecorder(object):
+
+    def __init__(self, path, chunk_size=5000, flush_interval=300.0,
+                 downsample_age=7*24*3600.0, downsample_bin=60.0, downsample_interval=24*3600.0):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.downsample_age = downsample_age
+        self.downsample_bin = downsample_bin
+        self.downsample_interval = downsample_interval
+        # 0: first flush after start catches up on old chunks
+        self.last_downsample = 0.0
+        self.downsample_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.buffers = dict()   # name -> list of (t, values)
+        self.last = dict()      # name -> last recorded values
+        self.last_flush = time.time()
+        self.categories = dict() # name -> list of strings
+        cat_fname = os.path.join(path, 'categories.json')
+        if os.path.exists(cat_fname):
+            with open(cat_fname, 'r') as f:
+                self.categories = json.load(f)
+
+    def _encode(self, name, value):
+        if isinstance(value, str):
+            cats = self.categories.setdefault(name, [])
+            if value not in cats:
+                cats.append(value)
+                self._save_categories()
+            return (float(cats.index(value)),)
+        return tuple(float(v) for v in np.ravel(value))
+
+    def _save_categories(self):
+        tmp_fname = os.path.join(self.path, 'categories.json.tmp')
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.categories, f)
+        os.replace(tmp_fname, os.path.join(self.path, 'categories.json'))
+
+    def record(self, name, value, t=None):
+        'append value if it differs from the last one recorded for name'
+        if t is None:
+            t = time.time()
+        with self.lock:
+            v = self._encode(name, value)
+            if self.last.get(name) == v:
+                return
+            self.last[name] = v
+            buf = self.buffers.setdefault(name, [])
+            buf.append((t,) + v)
+            full = len(buf) >= self.chunk_size
+        if full or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            buffers, self.buffers = self.buffers, dict()
+            self.last_flush = time.time()
+        for name, buf in buffers.items():
+            if buf:
+                a = np.array(buf, dtype=float)
+                self._write_chunk(name, a[:, 0], a[:, 1:])
+        if time.time() - self.last_downsample > self.downsample_interval:
+            # one downsample at a time, a concurrent flush just skips it
+            if self.downsample_lock.acquire(blocking=False):
+                try:
+                    self.last_downsample = time.time()
+                    self.downsample(self.downsample_age, self.downsample_bin)
+                finally:
+                    self.downsample_lock.release()
+
+    def _write_chunk(self, name, t, v, prefix=''):
+        dirname = os.path.join(self.path, name)
+        os.makedirs(dirname, exist_ok=True)
+        fname = os.path.join(dirname, '{}{:.3f}_{:.3f}.npz'.format(prefix, t[0], t[-1]))
+        tmp_fname = fname + '.tmp.npz'
+        np.savez(tmp_fname, t=t, v=v)
+        os.replace(tmp_fname, fname)
+
+    def chunks(self, name):
+        'sorted list of (t_first, t_last, fname, downsampled)'
+        dirname = os.path.join(self.path, name)
+        if not os.path.isdir(dirname):
+            return []
+        out = []
+        for fn in os.listdir(dirname):
+            if not fn.endswith('.npz') or '.tmp' in fn:
+                continue
+            ds = fn.startswith('ds_')
+            t0, t1 = fn[3 if ds else 0:-4].split('_')
+            out.append((float(t0), float(t1), os.path.join(dirname, fn), ds))
+        out.sort()
+        return out
+
+    def names(self):
+        return sorted(d for d in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, d)))
+
+    def query(self, name, t_start=None, t_end=None):
+        '''
+        returns t (N,), v (N, n_values) arrays of samples in [t_start, t_end]
+        '''
+        t_start = -np.inf if t_start is None else t_start
+        t_end = np.inf if t_end is None else t_end
+        ts, vs = [], []
+        for t0, t1, fname, ds in self.chunks(name):
+            if t1 < t_start or t0 > t_end:
+                continue
+            with np.load(fname) as d:
+                ts.append(d['t'])
+                vs.append(d['v'])
+        with self.lock:
+            buf = list(self.buffers.get(name, []))
+        if buf:
+            a = np.array(buf, dtype=float)
+            ts.append(a[:, 0])
+            vs.append(a[:, 1:])
+        if not ts:
+            return np.zeros(0), np.zeros((0, 0))
+        t = np.concatenate(ts)
+        v = np.concatenate(vs)
+        order = np.argsort(t, kind='stable')
+        t, v = t[order], v[order]
+        mask = (t >= t_start) & (t <= t_end)
+        return t[mask], v[mask]
+
+    def decode(self, name, codes):
+        'integer codes of a string valued parameter back to strings'
+        cats = self.categories.get(name, [])
+        return [cats[int(c)] for c in np.ravel(codes)]
+
+    def downsample(self, older_than=7*24*3600.0, bin_size=60.0):
+        '''
+        replace full resolution chunks older than older_than (s) by one chunk
+        holding the last value in each bin_size (s) interval
+        '''
+        t_cut = time.time() - older_than
+        for name in self.names():
+            old = [c for c in self.chunks(name) if c[1] < t_cut and not c[3]]
+            if not old:
+                continue
+            ts, vs = [], []
+            for t0, t1, fname, ds in old:
+                with np.load(fname) as d:
+                    ts.append(d['t'])
+                    vs.append(d['v'])
+            t = np.concatenate(ts)
+            v = np.concatenate(vs)
+            order = np.argsort(t, kind='stable')
+            t, v = t[order], v[order]
+            bins = np.floor(t / bin_size)
+            # last sample of each bin
+            keep = np.append(bins[1:] != bins[:-1], True)
+            self._write_chunk(name, t[keep], v[keep], prefix='ds_')
+            for t0, t1, fname, ds in old:
+                os.remove(fname)
+
+    def close(self):
+        self.flush()